@@ -0,0 +1,43 @@
+"""
+Time to flat when pulling every open order on a market: one cancel_order after another,
+versus the concurrent mass cancel behind cancel_orders, against the stub exchange.
+
+    python bench/bench_cancel.py [orders] [latency]
+"""
+import sys
+
+from common import stub_plugin, timed
+from test.stub_exchange import StubExchange
+
+
+def seed(stub, plugin, n):
+    for i in range(n):
+        stub.add_order('USDT_BTC', 'buy', 100 + i * 0.01, 0.01)
+    return plugin.get_open_orders(market='BTC_USD')
+
+
+def cleanup(plugin, orders):
+    for order in orders:
+        plugin.session.delete(order)
+    plugin.session.commit()
+
+
+def main(n=200, latency=0.05):
+    stub = StubExchange(latency=latency).start()
+    plugin = stub_plugin(stub)
+    try:
+        orders = seed(stub, plugin, n)
+        serial, _ = timed(lambda: [plugin.cancel_order(order=o) for o in orders])
+        cleanup(plugin, orders)
+        orders = seed(stub, plugin, n)
+        mass, (cancelled, _) = timed(plugin.cancel_orders, market='BTC_USD')
+        cleanup(plugin, orders)
+    finally:
+        stub.stop()
+    print("serial cancel_order: %d orders flat in %.3fs" % (n, serial))
+    print("mass cancel_orders:  %d orders flat in %.3fs" % (cancelled, mass))
+    return {'cancel_serial_seconds': serial, 'cancel_mass_seconds': mass}
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]] + [float(a) for a in sys.argv[2:]])
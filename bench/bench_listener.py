@@ -0,0 +1,40 @@
+"""
+Listener ticker throughput: push feed ticker messages from the stub exchange's stand-in feed through
+the listener's on_ticker handler, flushing to redis every ticker_flush_interval as the reactor would.
+
+    python bench/bench_listener.py [ticks] [markets]
+"""
+import sys
+import time
+
+from common import timed
+from test.stub_exchange import make_markets, ticker_feed
+
+
+def main(n=200000, markets=100):
+    import poloniex_listener
+    poloniex_listener.setup()
+    interval = float(poloniex_listener.poloniex.get_option('ticker_flush_interval',
+                                                           poloniex_listener.TICKER_FLUSH_INTERVAL))
+    messages = list(ticker_feed(n, make_markets(markets)))
+    writer = poloniex_listener.tickers
+
+    def run():
+        last = time.time()
+        for message in messages:
+            poloniex_listener.on_ticker(*message)
+            now = time.time()
+            if now - last >= interval:
+                writer.flush()
+                last = now
+        writer.flush()
+
+    seconds, _ = timed(run)
+    stats = writer.stats()
+    print("listener: %d ticks over %d markets in %.2fs, %.0f ticks/sec, %d written to redis"
+          % (n, markets, seconds, n / seconds, stats['written']))
+    return {'listener_ticks_per_sec': n / seconds}
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
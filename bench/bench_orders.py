@@ -0,0 +1,56 @@
+"""
+Order round trip latency against the stub exchange: create_order one order at a time, cancel_orders
+pulling them all, and a create_order followed straight away by its cancel_order.
+
+    python bench/bench_orders.py [orders] [latency]
+"""
+import sys
+import time
+
+from ledger import Amount
+
+from common import stub_plugin, timed
+from test.stub_exchange import StubExchange
+from trade_manager import em
+
+
+def pending_orders(plugin, n):
+    """n pending bids in the database, as trade_manager's create_order leaves them for the plugin."""
+    tag = int(time.time())
+    orders = [em.LimitOrder(Amount("%.2f USD" % (100 + i * 0.01)), Amount("0.01 BTC"), 'BTC_USD', 'bid',
+                            plugin.NAME, 'tmp|bench%d%05d' % (tag, i), exec_amount=Amount("0 BTC"), state='pending')
+              for i in range(n)]
+    plugin.session.add_all(orders)
+    plugin.session.commit()
+    return orders
+
+
+def cleanup(plugin, orders):
+    for order in orders:
+        plugin.session.delete(order)
+    plugin.session.commit()
+
+
+def main(n=100, latency=0.0):
+    stub = StubExchange(latency=latency).start()
+    plugin = stub_plugin(stub)
+    try:
+        orders = pending_orders(plugin, n)
+        create, _ = timed(lambda: [plugin.create_order(o.id) for o in orders])
+        cancel, (cancelled, _) = timed(plugin.cancel_orders, market='BTC_USD')
+        cleanup(plugin, orders)
+        orders = pending_orders(plugin, n)
+        round_trip, _ = timed(lambda: [plugin.cancel_order(order=plugin.create_order(o.id)) for o in orders])
+        cleanup(plugin, orders)
+    finally:
+        stub.stop()
+    results = {'create_order_ms': create / n * 1000, 'cancel_orders_seconds': cancel,
+               'round_trip_ms': round_trip / n * 1000}
+    print("create_order:             %.3f ms/order" % results['create_order_ms'])
+    print("cancel_orders:            %d orders flat in %.3fs" % (cancelled, cancel))
+    print("create_order+cancel_order: %.3f ms/round trip" % results['round_trip_ms'])
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]] + [float(a) for a in sys.argv[2:]])
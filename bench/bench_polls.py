@@ -0,0 +1,49 @@
+"""
+Cost of a sync_balances and a sync_orders poll against the stub exchange: the first poll, repeated polls
+of an account that has not changed, and the same repeated polls with response fingerprinting turned off.
+
+    python bench/bench_polls.py [polls] [currencies] [orders]
+"""
+import sys
+
+from common import stub_plugin, timed
+from poloniex_manager import load_by_ids
+from test.stub_exchange import StubExchange
+from trade_manager import em
+
+
+def per_poll(call, n):
+    seconds, _ = timed(lambda: [call() for _ in range(n)])
+    return seconds / n * 1000
+
+
+def main(n=200, currencies=100, orders=50):
+    stub = StubExchange(currencies=currencies).start()
+    order_ids = ['poloniex|%s' % stub.add_order('USDT_BTC', 'buy', 100 + i * 0.01, 0.01) for i in range(orders)]
+    results = {}
+    plugin = None
+    try:
+        plugin = stub_plugin(stub)
+        results['balances_first_ms'] = per_poll(plugin.sync_balances, 1)
+        results['balances_unchanged_ms'] = per_poll(plugin.sync_balances, n)
+        results['orders_first_ms'] = per_poll(plugin.sync_orders, 1)
+        results['orders_unchanged_ms'] = per_poll(plugin.sync_orders, n)
+        plugin = stub_plugin(stub, fingerprint_ttl=0)
+        results['balances_unfingerprinted_ms'] = per_poll(plugin.sync_balances, n)
+        results['orders_unfingerprinted_ms'] = per_poll(plugin.sync_orders, n)
+    finally:
+        stub.stop()
+        if plugin is not None:  # the orders sync_orders added, which would clash with the next run's
+            for order in load_by_ids(plugin.session, em.LimitOrder.order_id, order_ids).values():
+                plugin.session.delete(order)
+            plugin.session.commit()
+    print("sync_balances, %d currencies: first %.3f ms, unchanged %.3f ms/poll, without fingerprints %.3f ms/poll"
+          % (currencies, results['balances_first_ms'], results['balances_unchanged_ms'],
+             results['balances_unfingerprinted_ms']))
+    print("sync_orders, %d orders:       first %.3f ms, unchanged %.3f ms/poll, without fingerprints %.3f ms/poll"
+          % (orders, results['orders_first_ms'], results['orders_unchanged_ms'], results['orders_unfingerprinted_ms']))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,39 @@
+"""
+Cold start cost: the time a fresh interpreter takes to import each module, less the interpreter's own
+start up, and to import and set up the listener.
+
+    python bench/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['poloniex_api', 'poloniex_book', 'poloniex_manager', 'poloniex_listener']
+
+
+def cold(code, runs):
+    """Best wall clock seconds, over runs fresh interpreters, to run code."""
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(runs=5):
+    base = cold('pass', runs)
+    results = {}
+    for module in MODULES:
+        results['import_%s_ms' % module] = (cold('import %s' % module, runs) - base) * 1000
+    results['listener_setup_ms'] = (cold('import poloniex_listener; poloniex_listener.setup()', runs) - base) * 1000
+    for name in sorted(results):
+        print("%-32s %8.1f ms" % (name, results[name]))
+    return results
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
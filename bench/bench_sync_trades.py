@@ -0,0 +1,44 @@
+"""
+Trade history backfill throughput over a synthetic history served by the stub exchange:
+serial sync_trades(rescan=True), the parallel backfill_trades, and a re-run over known trades.
+
+    python bench/bench_sync_trades.py [trades] [latency]
+"""
+import sys
+
+from common import stub_plugin, timed
+from test.stub_exchange import StubExchange
+from trade_manager import em
+
+
+def cleanup(plugin, ids):
+    for i in range(0, len(ids), 500):
+        plugin.session.query(em.Trade).filter(em.Trade.trade_id.in_(ids[i:i + 500])) \
+            .delete(synchronize_session=False)
+    plugin.session.commit()
+    plugin.red.delete(plugin.cursor_key('trades_all'))
+
+
+def main(n=100000, latency=0.05):
+    stub = StubExchange(trades=n, latency=latency, page_size=1000).start()
+    plugin = stub_plugin(stub)
+    ids = ['poloniex|%s' % t['globalTradeID'] for t in stub.trades]
+    begin = stub.trades[-1]['_stamp'] - 1
+    try:
+        cleanup(plugin, ids)
+        serial, _ = timed(plugin.sync_trades, market=None, rescan=True)
+        cleanup(plugin, ids)
+        parallel, _ = timed(plugin.backfill_trades, begin=begin, window=(stub.trades[0]['_stamp'] - begin) / 16)
+        known, _ = timed(plugin.sync_trades, market=None, rescan=True)
+    finally:
+        stub.stop()
+        cleanup(plugin, ids)
+    print("serial backfill:     %d trades in %.2fs, %.0f rows/sec" % (n, serial, n / serial))
+    print("parallel backfill:   %d trades in %.2fs, %.0f rows/sec" % (n, parallel, n / parallel))
+    print("backfill, all known: %d trades in %.2fs, %.0f rows/sec" % (n, known, n / known))
+    return {'backfill_serial_rows_per_sec': n / serial, 'backfill_parallel_rows_per_sec': n / parallel,
+            'backfill_known_rows_per_sec': n / known}
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]] + [float(a) for a in sys.argv[2:]])
@@ -0,0 +1,36 @@
+"""
+Per-request latency of one-shot requests.get calls versus the pooled PoloniexTransport,
+measured against the local stub exchange.
+
+    python bench/bench_transport.py [requests]
+"""
+import sys
+
+import requests
+
+from common import timed
+from poloniex_api import PoloniexTransport
+from test.stub_exchange import StubExchange
+
+
+def per_request(call, n):
+    seconds, _ = timed(lambda: [call() for _ in range(n)])
+    return seconds / n * 1000
+
+
+def main(n=500):
+    stub = StubExchange().start()
+    url = stub.base_url + 'returnTicker'
+    try:
+        transport = PoloniexTransport()
+        one_shot = per_request(lambda: requests.get(url, timeout=10), n)
+        pooled = per_request(lambda: transport.get('returnTicker', url), n)
+    finally:
+        stub.stop()
+    print("one-shot requests.get: %.3f ms/request" % one_shot)
+    print("pooled transport:      %.3f ms/request" % pooled)
+    return {'transport_one_shot_ms': one_shot, 'transport_pooled_ms': pooled}
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,20 @@
+"""
+Helpers shared by the benchmarks.
+
+Benchmarks which touch the database use the session configured in ~/.tapp/poloniex/cfg.ini,
+so run them against a test database, as with the test suite.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from test.stub_exchange import stub_plugin  # noqa: E402 re-exported for the benchmarks
+
+
+def timed(call, *args, **kwargs):
+    """Run call, returning (seconds taken, result)."""
+    start = time.time()
+    result = call(*args, **kwargs)
+    return time.time() - start, result
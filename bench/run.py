@@ -0,0 +1,94 @@
+"""
+Run the benchmark suite with small, CI sized parameters, and compare the results with the baselines
+stored in bench/baselines.json. Exits non-zero if any result is worse than its baseline by more than
+the tolerance.
+
+    python bench/run.py                  # run everything and compare
+    python bench/run.py polls orders     # run some benchmarks only
+    python bench/run.py --save           # record the results as the new baselines
+
+Results ending in _per_sec are better when higher, all others (times) when lower.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+import common  # noqa, puts the repository on sys.path
+import bench_cancel
+import bench_listener
+import bench_orders
+import bench_polls
+import bench_startup
+import bench_sync_trades
+import bench_transport
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+TOLERANCE = 0.25  # fraction a result may be worse than its baseline before it counts as a regression
+
+SUITE = [
+    ('startup', bench_startup.main, {'runs': 5}),
+    ('transport', bench_transport.main, {'n': 200}),
+    ('sync_trades', bench_sync_trades.main, {'n': 20000, 'latency': 0.01}),
+    ('polls', bench_polls.main, {'n': 100, 'currencies': 100, 'orders': 50}),
+    ('orders', bench_orders.main, {'n': 50, 'latency': 0.0}),
+    ('cancel', bench_cancel.main, {'n': 50, 'latency': 0.01}),
+    ('listener', bench_listener.main, {'n': 50000, 'markets': 100}),
+]
+
+
+def compare(results, baselines, tolerance):
+    """Print each result against its baseline, returning the names of the regressions."""
+    regressions = []
+    for name in sorted(results):
+        value = results[name]
+        base = baselines.get(name)
+        if base is None:
+            print("%-34s %12.3f  (no baseline)" % (name, value))
+            continue
+        change = (value - base) / base if base else 0.0
+        worse = -change if name.endswith('_per_sec') else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print("%-34s %12.3f  baseline %12.3f  %+6.1f%%%s" % (name, value, base, change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite.")
+    parser.add_argument('benchmarks', nargs='*', help="benchmarks to run, default all: %s"
+                        % ", ".join(name for name, _, _ in SUITE))
+    parser.add_argument('--save', action='store_true', help="store the results as the new baselines")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, bench, params in SUITE:
+        if args.benchmarks and name not in args.benchmarks:
+            continue
+        print("== %s" % name)
+        results.update(bench(**params))
+
+    stored = {'results': {}}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            stored = json.load(f)
+    print("== results")
+    regressions = compare(results, stored['results'], args.tolerance)
+    if args.save:
+        stored['results'].update(results)
+        stored['recorded'] = datetime.datetime.utcnow().isoformat()
+        stored['host'] = platform.node()
+        with open(BASELINES, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print("baselines saved to %s" % BASELINES)
+        return 0
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
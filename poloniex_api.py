@@ -0,0 +1,813 @@
+"""
+Low level plumbing for talking to the Poloniex HTTP API.
+
+Kept free of trade_manager and sqlalchemy imports so it can be used (and
+benchmarked) on its own, and cheap to import: requests is only loaded once
+a transport is made.
+"""
+import bisect
+import calendar
+import codecs
+import datetime
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+try:
+    import ujson as fast_json
+except ImportError:  # fall back to the standard library parser
+    fast_json = json
+
+baseUrl = 'https://poloniex.com/public?command='
+privUrl = 'https://poloniex.com/tradingApi'
+
+REQ_TIMEOUT = 10  # seconds
+CONNECT_TIMEOUT = 3.05  # seconds, slightly above a TCP retransmit window
+POOL_SIZE = 10
+RATE_LIMIT = 6  # private calls per second allowed per key
+RATE_BURST = 6
+NONCE_RETRIES = 3  # times a request refused for its nonce is signed again and resent
+# ... when fanned out over concurrent workers, whose requests can reach poloniex out of nonce order
+CONCURRENT_NONCE_RETRIES = 20
+
+# request priority classes, lower goes first
+PRIORITY_CANCEL = 0
+PRIORITY_CREATE = 1
+PRIORITY_OPEN_ORDERS = 2
+PRIORITY_SYNC = 3
+PRIORITY_BACKFILL = 4
+
+PRIORITIES = {
+    'cancelOrder': PRIORITY_CANCEL,
+    'moveOrder': PRIORITY_CANCEL,
+    'buy': PRIORITY_CREATE,
+    'sell': PRIORITY_CREATE,
+    'returnOpenOrders': PRIORITY_OPEN_ORDERS,
+    'returnCompleteBalances': PRIORITY_SYNC,
+    'returnTradeHistory': PRIORITY_BACKFILL,
+    'returnDepositsWithdrawals': PRIORITY_BACKFILL,
+}
+
+SATOSHI = 10 ** 8  # poloniex amounts have 8 decimal places
+STREAM_CHUNK = 64 * 1024  # bytes read at a time from a streamed response
+MARKET_TTL = 24 * 60 * 60  # seconds before the market registry is rebuilt from poloniex
+PRECISION = 8  # decimal places poloniex accepts in rates and amounts
+MIN_TOTAL = 0.0001  # smallest order total poloniex accepts, in the pair's first currency
+MIN_TOTALS = {'USDT': 1.0}  # ... where it differs from MIN_TOTAL
+FINGERPRINT_TTL = 60  # seconds an unchanged response may be skipped for before it is processed again
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# read timeouts for commands that are known to be much faster or slower than REQ_TIMEOUT
+REQ_TIMEOUTS = {
+    'buy': 5,
+    'sell': 5,
+    'cancelOrder': 5,
+    'moveOrder': 5,
+    'returnTicker': 5,
+    'returnOrderBook': 5,
+    'returnTradeHistory': 30,
+    'returnDepositsWithdrawals': 30,
+}
+
+
+def loads(text):
+    """Parse a response body, with ujson when it is installed."""
+    return fast_json.loads(text)
+
+
+def to_satoshi(value):
+    """
+    Convert a poloniex decimal string such as '0.00150000' to an integer count of 1e-8 units,
+    without a round trip through float.
+    """
+    value = str(value)
+    if 'e' in value or 'E' in value:
+        return int(round(float(value) * SATOSHI))
+    negative = value.startswith('-')
+    whole, _, frac = value.lstrip('-+').partition('.')
+    satoshi = int(whole or 0) * SATOSHI + int((frac + '00000000')[:8])
+    return -satoshi if negative else satoshi
+
+
+def satoshi_str(satoshi):
+    """Format an integer count of 1e-8 units as a decimal string with 8 places."""
+    sign = '-' if satoshi < 0 else ''
+    return '%s%d.%08d' % (sign, abs(satoshi) // SATOSHI, abs(satoshi) % SATOSHI)
+
+
+def decimal_places(value):
+    """How many decimal places a number needs, e.g. 3 for '0.00150000'."""
+    value = str(value)
+    if 'e' in value or 'E' in value:
+        value = '%.16f' % float(value)
+    return len(value.partition('.')[2].rstrip('0'))
+
+
+_day_starts = {}
+
+
+def _format_market(market):
+    market = market.upper()
+    if 'USDT' in market:
+        market = market.replace('USDT', 'USD')
+    return "{1}_{0}".format(*market.split("_"))
+
+
+def _unformat_market(market):
+    if 'USD' in market and 'USDT' not in market:
+        market = market.replace('USD', 'USDT')
+    return "{1}_{0}".format(*market.split("_"))
+
+
+def _format_commodity(c):
+    return c if c != 'USDT' else 'USD'
+
+
+def _unformat_commodity(c):
+    return c if c != 'USD' else 'USDT'
+
+
+class MarketRegistry(object):
+    """
+    What poloniex trades, built from returnTicker and returnCurrencies: translation tables between poloniex
+    and trade_manager symbols in both directions, and each pair's precision, minimum order total and
+    whether it is frozen.
+
+    Symbol translation is a dict lookup. A symbol missing from the tables (say before the registry is first
+    built) is translated by rule, and the answer remembered.
+    """
+
+    def __init__(self):
+        self.updated = None  # when the registry was last built from poloniex
+        self.pairs = {}  # poloniex pair: {'market', 'precision', 'min_total', 'frozen'}
+        self.currencies = {}  # poloniex currency: returnCurrencies entry
+        self._markets = {}  # poloniex pair: trade_manager market
+        self._unmarkets = {}  # trade_manager market: poloniex pair
+        self._commodities = {}  # poloniex currency: trade_manager commodity
+        self._uncommodities = {}  # trade_manager commodity: poloniex currency
+
+    def format_market(self, pair):
+        """A poloniex currency pair, e.g. 'USDT_BTC', as a trade_manager market, e.g. 'BTC_USD'."""
+        try:
+            return self._markets[pair]
+        except KeyError:
+            market = self._markets[pair] = _format_market(pair)
+            return market
+
+    def unformat_market(self, market):
+        """A trade_manager market, e.g. 'BTC_USD', as a poloniex currency pair, e.g. 'USDT_BTC'."""
+        try:
+            return self._unmarkets[market]
+        except KeyError:
+            pair = self._unmarkets[market] = _unformat_market(market)
+            return pair
+
+    def format_commodity(self, c):
+        try:
+            return self._commodities[c]
+        except KeyError:
+            commodity = self._commodities[c] = _format_commodity(c)
+            return commodity
+
+    def unformat_commodity(self, c):
+        try:
+            return self._uncommodities[c]
+        except KeyError:
+            currency = self._uncommodities[c] = _unformat_commodity(c)
+            return currency
+
+    def update(self, ticker, currencies, updated=None):
+        """Rebuild the registry from a returnTicker and a returnCurrencies response."""
+        pairs = {}
+        for pair in ticker:
+            pairs[pair] = {'market': _format_market(pair), 'precision': PRECISION,
+                           'min_total': MIN_TOTALS.get(pair.split('_')[0], MIN_TOTAL),
+                           'frozen': str(ticker[pair].get('isFrozen', '0')) == '1'}
+        self.load(pairs, currencies, updated or time.time())
+
+    def load(self, pairs, currencies, updated):
+        """Replace the registry's contents, precomputing the translation tables."""
+        commodities = dict((c, _format_commodity(c)) for c in currencies)
+        for pair in pairs:
+            for c in pair.split('_'):
+                commodities.setdefault(c, _format_commodity(c))
+        # swap whole tables in, so lookups from other threads never see a half built one
+        self._markets = dict((pair, info['market']) for pair, info in pairs.items())
+        self._unmarkets = dict((info['market'], pair) for pair, info in pairs.items())
+        self._commodities = commodities
+        self._uncommodities = dict((commodity, c) for c, commodity in commodities.items())
+        self.pairs = pairs
+        self.currencies = currencies
+        self.updated = updated
+
+    def update_frozen(self, ticker):
+        """Update the frozen flags of the pairs the registry knows from a fresh returnTicker response."""
+        for pair, info in list(self.pairs.items()):
+            if pair in ticker:
+                frozen = str(ticker[pair].get('isFrozen', '0')) == '1'
+                if frozen != info['frozen']:
+                    self.pairs[pair] = dict(info, frozen=frozen)
+
+    def check_order(self, pair, rate, amount):
+        """
+        Why poloniex would refuse to buy or sell amount of pair at rate, or None if it should accept it.
+
+        Orders on pairs the registry does not know, say newly listed ones, are left for poloniex to judge.
+        """
+        info = self.pairs.get(pair)
+        if info is None:
+            return None
+        elif info['frozen']:
+            return "Market is frozen."
+        for value in (rate, amount):
+            if decimal_places(value) > info['precision']:
+                return "Invalid %s: more than %s decimal places." % (value, info['precision'])
+        srate = to_satoshi(rate)
+        samount = to_satoshi(amount)
+        if srate <= 0 or samount <= 0:
+            return "Rate and amount must be positive."
+        if srate * samount < to_satoshi(info['min_total']) * SATOSHI:
+            return "Total must be at least %s." % info['min_total']
+
+    def save(self, path):
+        """Cache the registry in a JSON file, written atomically."""
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'updated': self.updated, 'pairs': self.pairs, 'currencies': self.currencies}, f)
+        os.rename(tmp, path)
+
+    def read(self, path):
+        """Load the registry from a file written by save()."""
+        with open(path) as f:
+            cached = json.load(f)
+        self.load(cached['pairs'], cached['currencies'], cached['updated'])
+
+
+MARKETS = MarketRegistry()  # the process wide registry the symbol functions below translate with
+
+format_market = MARKETS.format_market
+unformat_market = MARKETS.unformat_market
+format_commodity = MARKETS.format_commodity
+unformat_commodity = MARKETS.unformat_commodity
+
+
+def parse_date(date):
+    """
+    Parse a poloniex "YYYY-MM-DD HH:MM:SS" UTC date to (unix time, naive datetime),
+    slicing the string instead of using strptime, and caching the start of each day.
+    """
+    day = date[:10]
+    start = _day_starts.get(day)
+    if start is None:
+        start = _day_starts[day] = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+    hour, minute, second = int(date[11:13]), int(date[14:16]), int(date[17:19])
+    return (start + hour * 3600 + minute * 60 + second,
+            datetime.datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), hour, minute, second))
+
+
+def parse_dates(rows, field='date'):
+    """parse_date the field of every row, returning a list of (unix time, naive datetime)."""
+    return [parse_date(row[field]) for row in rows]
+
+
+_END = object()
+
+
+class RowStream(object):
+    """
+    Incrementally parse a history response, such as returnTradeHistory or returnDepositsWithdrawals,
+    from an iterable of body chunks, yielding its rows one at a time as (group, row).
+
+    The body is either a list of row objects (group is None), or an object whose list members hold
+    the rows (group is the member's name, e.g. a currency pair, or 'deposits'). Other members, like
+    'error', are kept in extra. Only the unparsed tail of the body and the current row are held in
+    memory, however large the response.
+
+    A stream can only be iterated once.
+    """
+
+    def __init__(self, chunks):
+        self.extra = {}
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._decoder = json.JSONDecoder()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+        self._rows = self._parse()
+        self._head = None
+
+    def prime(self):
+        """Parse up to the first row, so a body without rows (such as an error) is known before iterating."""
+        if self._head is None:
+            self._head = next(self._rows, _END)
+
+    def get(self, key, default=None):
+        """A member of the body other than the rows, e.g. get('error')."""
+        self.prime()
+        return self.extra.get(key, default)
+
+    def __contains__(self, key):
+        self.prime()
+        return key in self.extra
+
+    def __nonzero__(self):
+        """False if the body holds no rows."""
+        self.prime()
+        return self._head is not _END
+
+    __bool__ = __nonzero__
+
+    def __iter__(self):
+        self.prime()
+        if self._head is _END:
+            return
+        yield self._head
+        for item in self._rows:
+            yield item
+
+    def _more(self):
+        """Read the next chunk into the buffer, dropping what has already been parsed. False at the end."""
+        if self._eof:
+            return False
+        chunk = next(self._chunks, None)
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        if chunk is None:
+            self._eof = True
+            self._buf += self._decode(b'', True)
+        else:
+            self._buf += self._decode(chunk)
+        return True
+
+    def _peek(self):
+        """The next non-whitespace character, without consuming it."""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in u' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                raise ValueError("truncated response")
+
+    def _value(self):
+        """Decode the next complete JSON value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._more():
+                    continue
+                raise
+            if end == len(self._buf) and self._more():
+                continue  # a number may go on into the next chunk
+            self._pos = end
+            return value
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError("expected %r at %r" % (char, self._buf[self._pos:self._pos + 20]))
+        self._pos += 1
+
+    def _list(self, group):
+        self._expect(u'[')
+        while True:
+            char = self._peek()
+            if char == u']':
+                self._pos += 1
+                return
+            elif char == u',':
+                self._pos += 1
+                continue
+            yield group, self._value()
+
+    def _parse(self):
+        char = self._peek()
+        if char == u'[':
+            for item in self._list(None):
+                yield item
+        elif char == u'{':
+            self._pos += 1
+            while True:
+                char = self._peek()
+                if char == u'}':
+                    self._pos += 1
+                    break
+                elif char == u',':
+                    self._pos += 1
+                    continue
+                key = self._value()
+                self._expect(u':')
+                if self._peek() == u'[':
+                    for item in self._list(key):
+                        yield item
+                else:
+                    self.extra[key] = self._value()
+        else:
+            self.extra['value'] = self._value()
+
+
+def batches(rows, size):
+    """Group a RowStream's (group, row) pairs into (group, [row, ...]) lists of at most size rows."""
+    group, batch = None, []
+    for rgroup, row in rows:
+        if len(batch) > 0 and (rgroup != group or len(batch) >= size):
+            yield group, batch
+            batch = []
+        group = rgroup
+        batch.append(row)
+    if len(batch) > 0:
+        yield group, batch
+
+
+class PoloniexTransport(object):
+    """
+    Keep-alive, connection pooled HTTP transport shared by the public and trading API.
+
+    Every request made through the same transport reuses the TCP+TLS connections in its pool,
+    so only the first call to poloniex.com pays for the handshake.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeouts=None, http2=False):
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if http2:
+            try:
+                from hyper.contrib import HTTP20Adapter
+            except ImportError:
+                raise ValueError("http2 transport requires the 'hyper' package")
+            self.session.mount('https://poloniex.com', HTTP20Adapter())
+        self.timeouts = dict(REQ_TIMEOUTS)
+        if timeouts is not None:
+            self.timeouts.update(timeouts)
+
+    def timeout(self, command):
+        """(connect, read) timeout tuple for the given API command."""
+        return CONNECT_TIMEOUT, self.timeouts.get(command, REQ_TIMEOUT)
+
+    def get(self, command, url):
+        return self.session.get(url, timeout=self.timeout(command))
+
+    def post(self, command, url, data, headers, stream=False):
+        return self.session.post(url, data=data, headers=headers, timeout=self.timeout(command), stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+class RequestScheduler(object):
+    """
+    Token bucket rate limiter which hands out tokens strictly by priority.
+
+    Callers block in acquire() until they are the most urgent waiter and a token is available,
+    so a cancelOrder queued behind a history backfill still goes out on the very next token.
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._last = time.time()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._counter = itertools.count()
+        self.depth = dict((p, 0) for p in PRIORITIES.values())
+        self.granted = dict((p, 0) for p in PRIORITIES.values())
+        self.waited = dict((p, 0.0) for p in PRIORITIES.values())
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, priority=PRIORITY_SYNC):
+        """Block until a request of the given priority may be sent."""
+        start = time.time()
+        with self._cond:
+            entry = (priority, next(self._counter))
+            heapq.heappush(self._waiting, entry)
+            self.depth[priority] = self.depth.get(priority, 0) + 1
+            try:
+                while True:
+                    if self._waiting[0] == entry:
+                        self._refill()
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            break
+                        self._cond.wait((1 - self._tokens) / self.rate)
+                    else:
+                        self._cond.wait()
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self.depth[priority] -= 1
+                self._cond.notify_all()
+            self.granted[priority] = self.granted.get(priority, 0) + 1
+            self.waited[priority] = self.waited.get(priority, 0.0) + time.time() - start
+
+    def try_acquire(self, priority=PRIORITY_SYNC):
+        """Take a token without blocking, if one is free and no more urgent caller is waiting in acquire()."""
+        with self._cond:
+            if self._waiting and self._waiting[0][0] <= priority:
+                return False
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            self.granted[priority] = self.granted.get(priority, 0) + 1
+            return True
+
+    def stats(self):
+        """Current queue depth, plus tokens granted and total seconds waited, per priority class."""
+        with self._cond:
+            return {'depth': dict(self.depth), 'granted': dict(self.granted), 'waited': dict(self.waited)}
+
+
+UNCHANGED = object()  # returned instead of a response whose body matches the last one processed
+
+
+class ResponseFingerprints(object):
+    """
+    Remembers a hash of the last body seen for each endpoint, so a poll returning exactly what it
+    returned last time can skip parsing and database work.
+
+    A fingerprint is trusted for at most ttl seconds, and should be forgotten whenever the local state
+    the response was applied to changes another way (e.g. an order was placed), or applying it failed.
+    Counts hits (responses skipped) and misses per endpoint.
+    """
+
+    def __init__(self, ttl=FINGERPRINT_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._seen = {}  # key: (digest, time seen)
+        self.hits = {}
+        self.misses = {}
+
+    def unchanged(self, key, body):
+        """
+        True if body is the same as the last one remembered for key. Otherwise remembers it and returns False.
+
+        :param body: the raw response body, as bytes
+        """
+        digest = hashlib.sha1(body).digest()
+        now = time.time()
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and last[0] == digest and now - last[1] < self.ttl:
+                self.hits[key] = self.hits.get(key, 0) + 1
+                return True
+            self._seen[key] = (digest, now)
+            self.misses[key] = self.misses.get(key, 0) + 1
+            return False
+
+    def forget(self, prefix):
+        """Forget the fingerprints of every key starting with prefix, so their next response is processed."""
+        with self._lock:
+            for key in [k for k in self._seen if k.startswith(prefix)]:
+                del self._seen[key]
+
+    def stats(self):
+        """hits, misses and hit_rate per key."""
+        with self._lock:
+            stats = {}
+            for key in set(self.hits) | set(self.misses):
+                hits = self.hits.get(key, 0)
+                misses = self.misses.get(key, 0)
+                stats[key] = {'hits': hits, 'misses': misses, 'hit_rate': float(hits) / (hits + misses)}
+            return stats
+
+
+class Histogram(object):
+    """Counts of observations falling in each of LATENCY_BUCKETS (plus one overflow bucket), with their sum."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, or None if nothing was observed."""
+        if self.count == 0:
+            return None
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return bound
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': list(self.counts),
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+
+class Metrics(object):
+    """
+    Process wide instrumentation: latency histograms per API command and per sync, counts of errors,
+    timeouts and nonce retries per command, and rows processed and seconds spent on the database per sync.
+
+    Rows and database time are charged to the sync running on the current thread (see sync()).
+    snapshot() gives a JSON-able view, and text() the same in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = time.time()
+        self.requests = {}  # command: Histogram
+        self.syncs = {}  # sync: Histogram
+        self.counters = {}  # (kind, command or sync): count
+        self.rows = {}  # sync: rows processed
+        self.db_seconds = {}  # sync: seconds
+
+    @property
+    def current(self):
+        """Name of the sync running on this thread, if any."""
+        return getattr(self._local, 'sync', None)
+
+    def observe(self, command, seconds):
+        """Record the latency of one API request."""
+        with self._lock:
+            if command not in self.requests:
+                self.requests[command] = Histogram()
+            self.requests[command].observe(seconds)
+
+    def count(self, kind, name, n=1):
+        """Count an event, e.g. count('timeout', 'returnTradeHistory')."""
+        with self._lock:
+            self.counters[(kind, name)] = self.counters.get((kind, name), 0) + n
+
+    def add_rows(self, n):
+        """Count rows processed by the current sync."""
+        name = self.current or 'other'
+        with self._lock:
+            self.rows[name] = self.rows.get(name, 0) + n
+
+    def sync(self, name):
+        """Context manager timing a sync, counting it as an error if it raises."""
+        return _SyncTimer(self, name)
+
+    def db(self):
+        """
+        Context manager charging the seconds spent inside it to the current sync's database time.
+        Nested uses are only counted once.
+        """
+        return _DbTimer(self)
+
+    def snapshot(self):
+        with self._lock:
+            counters = {}
+            for (kind, name), n in self.counters.items():
+                counters.setdefault(kind, {})[name] = n
+            return {'uptime': time.time() - self.started,
+                    'requests': dict((k, h.snapshot()) for k, h in self.requests.items()),
+                    'syncs': dict((k, h.snapshot()) for k, h in self.syncs.items()),
+                    'counters': counters,
+                    'rows': dict(self.rows), 'db_seconds': dict(self.db_seconds)}
+
+    def text(self, prefix='poloniex'):
+        """The metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for metric, label, histograms in (('request_seconds', 'command', self.requests),
+                                              ('sync_seconds', 'sync', self.syncs)):
+                lines.append('# TYPE %s_%s histogram' % (prefix, metric))
+                for name in sorted(histograms):
+                    h = histograms[name]
+                    cumulative = 0
+                    for bound, count in zip(h.bounds + ('+Inf',), h.counts):
+                        cumulative += count
+                        lines.append('%s_%s_bucket{%s="%s",le="%s"} %d' % (prefix, metric, label, name, bound,
+                                                                           cumulative))
+                    lines.append('%s_%s_sum{%s="%s"} %f' % (prefix, metric, label, name, h.sum))
+                    lines.append('%s_%s_count{%s="%s"} %d' % (prefix, metric, label, name, h.count))
+            lines.append('# TYPE %s_events_total counter' % prefix)
+            for (kind, name), n in sorted(self.counters.items()):
+                lines.append('%s_events_total{kind="%s",name="%s"} %d' % (prefix, kind, name, n))
+            lines.append('# TYPE %s_rows_total counter' % prefix)
+            for name, n in sorted(self.rows.items()):
+                lines.append('%s_rows_total{sync="%s"} %d' % (prefix, name, n))
+            lines.append('# TYPE %s_db_seconds_total counter' % prefix)
+            for name, n in sorted(self.db_seconds.items()):
+                lines.append('%s_db_seconds_total{sync="%s"} %f' % (prefix, name, n))
+        return '\n'.join(lines) + '\n'
+
+
+class _SyncTimer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.outer = self.metrics.current
+        self.metrics._local.sync = self.name
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.time() - self.start
+        self.metrics._local.sync = self.outer
+        with self.metrics._lock:
+            if self.name not in self.metrics.syncs:
+                self.metrics.syncs[self.name] = Histogram()
+            self.metrics.syncs[self.name].observe(elapsed)
+        if exc_type is not None:
+            self.metrics.count('error', self.name)
+
+
+class _DbTimer(object):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def __enter__(self):
+        local = self.metrics._local
+        local.db_depth = getattr(local, 'db_depth', 0) + 1
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.time() - self.start
+        local = self.metrics._local
+        local.db_depth -= 1
+        if local.db_depth > 0:
+            return
+        name = self.metrics.current or 'other'
+        with self.metrics._lock:
+            self.metrics.db_seconds[name] = self.metrics.db_seconds.get(name, 0.0) + elapsed
+
+
+class LocalNonce(object):
+    """Strictly increasing millisecond based nonces, safe across the threads of one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = 0
+
+    def next_nonce(self):
+        with self._lock:
+            self._last = max(self._last + 1, int(time.time() * 1000))
+            return self._last
+
+
+class FileNonce(object):
+    """
+    Strictly increasing nonces shared by every process on the host,
+    using a high-water mark kept in a flock()ed file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()  # flock does not exclude threads sharing a process
+
+    def next_nonce(self):
+        import fcntl
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                last = int(os.read(fd, 32) or 0)
+                nonce = max(last + 1, int(time.time() * 1000))
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, str(nonce).encode('ascii'))
+                return nonce
+            finally:
+                os.close(fd)  # releases the flock
+
+
+class RedisNonce(object):
+    """Strictly increasing nonces shared by every process using the same redis, key by key."""
+    SCRIPT = """
+local last = tonumber(redis.call('get', KEYS[1]) or '0')
+local nonce = tonumber(ARGV[1])
+if nonce <= last then
+    nonce = last + 1
+end
+redis.call('set', KEYS[1], nonce)
+return nonce
+"""
+
+    def __init__(self, red, key):
+        self.key = key
+        self._script = red.register_script(self.SCRIPT)
+
+    def next_nonce(self):
+        return int(self._script(keys=[self.key], args=[int(time.time() * 1000)]))
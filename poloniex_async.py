@@ -0,0 +1,222 @@
+"""
+Non-blocking flavour of the Poloniex plugin, built on Twisted like poloniex_listener.
+
+AsyncPoloniex offers the plugin's sync and order methods as inlineCallbacks coroutines returning Deferreds.
+HTTP requests are made on the reactor through a persistent connection pool, while all database work
+runs on one dedicated thread, since a sqlalchemy session must not be shared between threads.
+Nonces are taken on the reactor's thread pool, as the nonce stores block on redis or a file lock.
+Independent syncs run concurrently, and order actions take rate limit tokens ahead of syncs and backfills.
+"""
+import heapq
+import itertools
+from io import BytesIO
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.http_headers import Headers
+
+from poloniex_api import CONCURRENT_NONCE_RETRIES, NONCE_RETRIES, POOL_SIZE, PRIORITIES, PRIORITY_SYNC, loads
+from poloniex_manager import Poloniex, em, load_by_ids
+
+
+class AsyncPoloniex(object):
+    def __init__(self, plugin=None):
+        self.plugin = plugin if plugin is not None else Poloniex()
+        self.logger = self.plugin.logger
+        self.dbpool = ThreadPool(1, 1, name='poloniex-db')
+        self.dbpool.start()
+        self._shutdown = reactor.addSystemEventTrigger('before', 'shutdown', self.dbpool.stop)
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = int(self.plugin.get_option('pool_size', POOL_SIZE))
+        self.agent = Agent(reactor, pool=self.pool)
+        self._waiting = []
+        self._counter = itertools.count()
+        self._pump_call = None
+
+    def close(self):
+        """Stop the database thread and close the kept-alive connections, returning a Deferred of the latter."""
+        reactor.removeSystemEventTrigger(self._shutdown)
+        self.dbpool.stop()
+        if self._pump_call is not None and self._pump_call.active():
+            self._pump_call.cancel()
+        return self.pool.closeCachedConnections()
+
+    def db(self, f, *args, **kwargs):
+        """Run f on the database thread, returning a Deferred of its result."""
+        return deferToThreadPool(reactor, self.dbpool, f, *args, **kwargs)
+
+    def acquire(self, priority=PRIORITY_SYNC):
+        """A Deferred firing when a request of priority may be sent, sharing the plugin's rate budget."""
+        d = Deferred()
+        heapq.heappush(self._waiting, (priority, next(self._counter), d))
+        self._pump()
+        return d
+
+    def _pump(self):
+        while self._waiting and self.plugin.scheduler.try_acquire(self._waiting[0][0]):
+            heapq.heappop(self._waiting)[2].callback(None)
+        if self._waiting and (self._pump_call is None or not self._pump_call.active()):
+            self._pump_call = reactor.callLater(1.0 / self.plugin.scheduler.rate, self._pump)
+
+    @inlineCallbacks
+    def request(self, command, method, url, body=None, headers=None):
+        headers = Headers(dict((k, [v]) for k, v in (headers or {}).items()))
+        producer = FileBodyProducer(BytesIO(body)) if body is not None else None
+        d = self.agent.request(method, url, headers, producer)
+        d.addTimeout(sum(self.plugin.transport.timeout(command)), reactor)
+        tstart = reactor.seconds()
+        try:
+            response = yield d
+            body = yield readBody(response)
+        finally:
+            self.plugin.metrics.observe(command, reactor.seconds() - tstart)
+        returnValue(loads(body))
+
+    @inlineCallbacks
+    def submit_private_request(self, method, params=None, retry=0, priority=None, retries=NONCE_RETRIES):
+        """Non-blocking Poloniex.submit_private_request."""
+        params = params if params is not None else {}
+        if priority is None:
+            priority = PRIORITIES.get(method, PRIORITY_SYNC)
+        yield self.acquire(priority)
+        data, headers = yield deferToThread(self.plugin.sign_request, method, params)
+        try:
+            response = yield self.request(method, 'POST', self.plugin.priv_url, data, headers)
+        except Exception as e:
+            self.plugin.metrics.count('error', method)
+            self.logger.exception(e)
+            returnValue(None)
+        if isinstance(response, dict) and "Invalid nonce" in str(response.get('error')) and retry < retries:
+            self.plugin.metrics.count('nonce_retry', method)
+            response = yield self.submit_private_request(method, params=params, retry=retry + 1, priority=priority,
+                                                         retries=retries)
+        returnValue(response)
+
+    @inlineCallbacks
+    def submit_public_request(self, method, params=None):
+        """Non-blocking Poloniex.submit_public_request."""
+        params = params if params is not None else {}
+        url = self.plugin.base_url + method
+        for param in params:
+            url += '&%s=%s' % (param, params[param])
+        try:
+            response = yield self.request(method, 'GET', url)
+        except Exception as e:
+            self.plugin.metrics.count('error', method)
+            self.logger.exception(e)
+            returnValue(None)
+        returnValue(response)
+
+    @inlineCallbacks
+    def sync_ticker(self, market='BTC_USD'):
+        full_ticker = yield self.submit_public_request('returnTicker')
+        tick = yield self.db(self.plugin.apply_ticker, full_ticker, market)
+        returnValue(tick)
+
+    @inlineCallbacks
+    def sync_balances(self):
+        data = yield self.submit_private_request('returnCompleteBalances')
+        yield self.db(self.plugin.apply_balances, data)
+
+    @inlineCallbacks
+    def get_open_orders(self, market=None):
+        pair = 'all' if market is None else self.plugin.unformat_market(market)
+        oorders = yield self.submit_private_request('returnOpenOrders', {'currencyPair': pair})
+        orders = yield self.db(self.plugin.apply_open_orders, oorders, market)
+        returnValue(orders)
+
+    @inlineCallbacks
+    def sync_orders(self):
+        oorders = yield self.get_open_orders()
+        yield self.db(self.plugin.close_vanished_orders, oorders)
+
+    @inlineCallbacks
+    def create_order(self, oid, expire=None):
+        order, side, options = yield self.db(self.plugin.prepare_order, oid, expire)
+        if order is None:
+            returnValue(None)
+        resp = self.plugin.check_order(options)
+        if resp is None:
+            resp = yield self.submit_private_request(side, dict(options))
+        order = yield self.db(self.plugin.apply_created_order, order, options, resp)
+        returnValue(order)
+
+    @inlineCallbacks
+    def create_orders(self, oids, expire=None):
+        """Submit many pending orders at once, with one query to load them and one commit."""
+        orders = yield self.db(load_by_ids, self.plugin.session, em.LimitOrder.id, oids)
+        prepared = yield self.db(lambda: [self.plugin.prepare_order(oid, expire, order=orders.get(oid), loaded=True)
+                                          for oid in oids])
+        prepared = [p for p in prepared if p[0] is not None]
+        rejected = [self.plugin.check_order(options) for _, _, options in prepared]
+        responses = yield DeferredList([self.submit_private_request(side, dict(options),
+                                                                    retries=CONCURRENT_NONCE_RETRIES)
+                                        for (_, side, options), rejection in zip(prepared, rejected)
+                                        if rejection is None], consumeErrors=True)
+        sent = iter([resp if ok else None for ok, resp in responses])
+        created = yield self.db(self.plugin.apply_created_orders,
+                                [(order, options, rejection or next(sent))
+                                 for (order, _, options), rejection in zip(prepared, rejected)])
+        returnValue(created)
+
+    @inlineCallbacks
+    def cancel_order(self, oid=None, order_id=None, order=None):
+        order = yield self.db(self.plugin.find_order, oid, order_id, order)
+        if order is None:
+            returnValue(None)
+        order_number = yield self.db(lambda: order.order_id.split("|")[1])
+        resp = yield self.submit_private_request('cancelOrder', {'orderNumber': order_number})
+        yield self.db(self.plugin.apply_cancelled_order, order, resp)
+
+    @inlineCallbacks
+    def cancel_orders(self, market=None, side=None, price=None):
+        """
+        Cancel the matching open orders, all at once rather than one after another, and record them in one commit.
+
+        :return: the number of orders cancelled, and the seconds taken to get flat
+        """
+        tstart = reactor.seconds()
+        open_orders = yield self.get_open_orders(market=market)
+        # ORM attributes are only touched on the database thread
+        orders = yield self.db(lambda: [(o, o.order_id.split("|")[1])
+                                        for o in self.plugin.select_orders(open_orders, market, side, price)])
+        responses = yield DeferredList([self.submit_private_request('cancelOrder', {'orderNumber': order_number},
+                                                                    retries=CONCURRENT_NONCE_RETRIES)
+                                        for _, order_number in orders], consumeErrors=True)
+        cancelled = yield self.db(self.plugin.apply_cancelled_orders,
+                                  [(o, resp if ok else None) for (o, _), (ok, resp) in zip(orders, responses)])
+        elapsed = reactor.seconds() - tstart
+        self.logger.info("poloniex cancelled %s of %s orders, flat in %.3fs" % (cancelled, len(orders), elapsed))
+        returnValue((cancelled, elapsed))
+
+    @inlineCallbacks
+    def sync_trades(self, market=None, rescan=False):
+        """Poloniex.sync_trades, only holding the database thread while each page is written."""
+        tstart = reactor.seconds()
+        begin, tend = yield self.db(self.plugin.start_trade_sync, market, rescan, tstart)
+        lastend = tend - 1
+        while tend != lastend and (begin is None or tend > begin):
+            lastend = tend
+            params = {'currencyPair': 'all' if market is None else self.plugin.unformat_market(market),
+                      'end': str(int(tend))}
+            if begin is not None:
+                params['start'] = str(int(begin))
+            trades = yield self.submit_private_request('returnTradeHistory', params)
+            if trades is None or 'error' in trades:
+                self.logger.warning("poloniex unable to get trade history: %r" % trades)
+                returnValue(None)
+            elif len(trades) == 0:
+                break
+            tend = yield self.db(self.plugin.apply_trade_page, trades, market, tend, rescan)
+            if not rescan and begin is None:
+                break
+        yield self.db(self.plugin.finish_trade_sync, market, rescan, tstart)
+
+    def sync_all(self, markets=('BTC_USD',)):
+        """Run the ticker, balance, order and trade syncs concurrently."""
+        syncs = [self.sync_ticker(market) for market in markets]
+        syncs.extend([self.sync_balances(), self.sync_orders(), self.sync_trades()])
+        return DeferredList(syncs, consumeErrors=True)
@@ -0,0 +1,289 @@
+"""
+In-memory level 2 order books for Poloniex markets.
+
+A book is seeded from a returnOrderBook snapshot, then kept current from the push feed's
+orderBookModify / orderBookRemove messages, using the feed's sequence numbers to drop stale
+messages and detect gaps.
+"""
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import deque
+
+try:
+    import numpy
+except ImportError:  # the analytics fall back to plain python
+    numpy = None
+
+BOOK_KEY = 'poloniex_%s_book'  # redis key of a market's published book snapshot
+BOOK_BLOB_KEY = 'poloniex_%s_book_bin'  # redis key of a market's BookSnapshot blob
+BOOK_DEPTH = 100  # levels per side requested from returnOrderBook
+PUBLISH_DEPTH = 20  # levels per side published to redis
+PENDING_LIMIT = 10000  # feed messages buffered while a book waits for its snapshot; the oldest are dropped
+
+
+class BookGap(Exception):
+    """A push feed message was missed, so the book must be re-seeded from a snapshot."""
+
+
+class BookSide(object):
+    """
+    The price levels of one side of a book.
+
+    Levels live in a dict keyed by price, plus a sorted list of prices, so size lookups are O(1) and the
+    best price is always at the front or back. Adding or removing a level finds its position with a
+    O(log n) bisect, but the list insert or delete is a O(n) memmove. For books of a few hundred levels
+    that is still cheaper than a tree.
+    """
+
+    def __init__(self, descending=False):
+        self.descending = descending
+        self.sizes = {}
+        self.prices = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def clear(self):
+        self.sizes = {}
+        self.prices = []
+
+    def set(self, price, size):
+        """Set the size at price; a size of 0 removes the level."""
+        if size <= 0:
+            self.remove(price)
+        elif price in self.sizes:
+            self.sizes[price] = size
+        else:
+            self.sizes[price] = size
+            insort(self.prices, price)
+
+    def remove(self, price):
+        if self.sizes.pop(price, None) is not None:
+            del self.prices[bisect_left(self.prices, price)]
+
+    def best(self):
+        """(price, size) of the best level, or None if the side is empty."""
+        if len(self.prices) == 0:
+            return None
+        price = self.prices[-1] if self.descending else self.prices[0]
+        return price, self.sizes[price]
+
+    def levels(self, n=None):
+        """The best n (default all) levels as (price, size), best first."""
+        if self.descending:
+            prices = self.prices[::-1] if n is None else self.prices[:-n - 1:-1]
+        else:
+            prices = self.prices if n is None else self.prices[:n]
+        return [(price, self.sizes[price]) for price in prices]
+
+
+class OrderBook(object):
+    def __init__(self, market):
+        self.market = market
+        self.bids = BookSide(descending=True)
+        self.asks = BookSide()
+        self.seq = None
+        self.updated = None
+        self._pending = deque(maxlen=PENDING_LIMIT)  # (seq, updates) that arrived before the snapshot
+
+    @property
+    def seeded(self):
+        return self.seq is not None
+
+    def load_snapshot(self, snapshot):
+        """
+        Replace the book's contents with a returnOrderBook response, then replay any buffered
+        feed messages newer than it.
+
+        :raises BookGap: if the buffered messages do not follow on from the snapshot.
+        """
+        self.bids.clear()
+        self.asks.clear()
+        for price, size in snapshot['bids']:
+            self.bids.set(float(price), float(size))
+        for price, size in snapshot['asks']:
+            self.asks.set(float(price), float(size))
+        self.seq = int(snapshot['seq'])
+        self.updated = time.time()
+        pending, self._pending = self._pending, deque(maxlen=PENDING_LIMIT)
+        for seq, updates in sorted(pending, key=lambda p: p[0]):
+            if seq > self.seq:
+                self.apply(seq, updates)
+
+    def apply(self, seq, updates):
+        """
+        Apply one push feed message: its sequence number and list of updates.
+
+        Messages older than the book are ignored, and the latest PENDING_LIMIT messages arriving before the
+        snapshot are buffered. If older ones had to be dropped, replaying them raises BookGap.
+        :raises BookGap: if a message was skipped. The book is then unseeded until the next snapshot.
+        """
+        if self.seq is None:
+            self._pending.append((seq, updates))
+            return
+        elif seq <= self.seq:
+            return
+        elif seq != self.seq + 1:
+            missed = seq - self.seq - 1
+            self.seq = None
+            self._pending = deque([(seq, updates)], maxlen=PENDING_LIMIT)
+            raise BookGap("%s book missed %s messages before %s" % (self.market, missed, seq))
+        for update in updates:
+            data = update.get('data', {})
+            side = self.bids if data.get('type') == 'bid' else self.asks
+            if update.get('type') == 'orderBookModify':
+                side.set(float(data['rate']), float(data['amount']))
+            elif update.get('type') == 'orderBookRemove':
+                side.remove(float(data['rate']))
+        self.seq = seq
+        self.updated = time.time()
+
+    def top(self):
+        """(best bid, best ask), each (price, size) or None."""
+        return self.bids.best(), self.asks.best()
+
+    def depth(self, n=10):
+        """The best n bid and ask levels."""
+        return self.bids.levels(n), self.asks.levels(n)
+
+    def snapshot(self, n=None):
+        """A JSON-able view of the best n levels (default all), for publishing."""
+        bids, asks = self.depth(n)
+        return {'market': self.market, 'exchange': 'poloniex', 'seq': self.seq, 'time': self.updated,
+                'bids': bids, 'asks': asks}
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array('d', values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def _from_bytes(blob):
+    values = array('d')
+    if hasattr(values, 'frombytes'):
+        values.frombytes(blob)
+    else:
+        values.fromstring(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class BookSnapshot(object):
+    """
+    A compact, immutable view of an order book: the prices and sizes of each side held in contiguous
+    arrays of doubles, best level first, with no per level python objects.
+
+    Snapshots serialize to a small binary blob for redis, and offer depth analytics that are
+    vectorized with numpy when it is installed.
+    """
+    HEADER = struct.Struct('<4sHqII')  # magic, market length, seq, bid levels, ask levels
+    MAGIC = b'PLB1'
+
+    def __init__(self, market, bid_prices, bid_sizes, ask_prices, ask_sizes, seq=None):
+        self.market = market
+        self.seq = seq
+        self.bid_prices = bid_prices
+        self.bid_sizes = bid_sizes
+        self.ask_prices = ask_prices
+        self.ask_sizes = ask_sizes
+
+    @classmethod
+    def from_book(cls, book, n=None):
+        """Snapshot the best n levels (default all) of an OrderBook."""
+        bids, asks = book.depth(n)
+        return cls(book.market, array('d', [p for p, _ in bids]), array('d', [s for _, s in bids]),
+                   array('d', [p for p, _ in asks]), array('d', [s for _, s in asks]), seq=book.seq)
+
+    @classmethod
+    def from_response(cls, market, response):
+        """Snapshot a returnOrderBook response, converting its [price, size] pairs straight into arrays."""
+        bids = response['bids']
+        asks = response['asks']
+        return cls(market,
+                   array('d', [float(level[0]) for level in bids]), array('d', [float(level[1]) for level in bids]),
+                   array('d', [float(level[0]) for level in asks]), array('d', [float(level[1]) for level in asks]),
+                   seq=int(response['seq']) if 'seq' in response else None)
+
+    def to_bytes(self):
+        market = self.market.encode('utf-8')
+        seq = -1 if self.seq is None else self.seq
+        return b''.join([self.HEADER.pack(self.MAGIC, len(market), seq, len(self.bid_prices), len(self.ask_prices)),
+                         market, _to_bytes(self.bid_prices), _to_bytes(self.bid_sizes),
+                         _to_bytes(self.ask_prices), _to_bytes(self.ask_sizes)])
+
+    @classmethod
+    def from_bytes(cls, blob):
+        magic, mlen, seq, nbids, nasks = cls.HEADER.unpack_from(blob)
+        if magic != cls.MAGIC:
+            raise ValueError("not a book snapshot")
+        offset = cls.HEADER.size
+        market = blob[offset:offset + mlen].decode('utf-8')
+        offset += mlen
+        arrays = []
+        for n in (nbids, nbids, nasks, nasks):
+            arrays.append(_from_bytes(blob[offset:offset + n * 8]))
+            offset += n * 8
+        return cls(market, *arrays, seq=None if seq == -1 else seq)
+
+    def _side(self, side):
+        """prices and sizes of the book side an order of side would take liquidity from."""
+        if side == 'bid':  # buying lifts the asks
+            return self.ask_prices, self.ask_sizes
+        return self.bid_prices, self.bid_sizes
+
+    def cumulative_depth(self, side):
+        """Running total of size available to an order of side ('bid' or 'ask'), level by level."""
+        _, sizes = self._side(side)
+        if numpy is not None:
+            return numpy.cumsum(numpy.frombuffer(sizes, dtype=numpy.float64))
+        total = 0.0
+        cumulative = array('d')
+        for size in sizes:
+            total += size
+            cumulative.append(total)
+        return cumulative
+
+    def vwap(self, side, size):
+        """
+        Average price an order of side ('bid' or 'ask') would pay to fill size by taking liquidity,
+        or None if the book is not deep enough.
+        """
+        prices, sizes = self._side(side)
+        if size <= 0 or len(prices) == 0:
+            return None
+        if numpy is not None:
+            prices = numpy.frombuffer(prices, dtype=numpy.float64)
+            sizes = numpy.frombuffer(sizes, dtype=numpy.float64)
+            cumulative = numpy.cumsum(sizes)
+            if cumulative[-1] < size:
+                return None
+            last = int(numpy.searchsorted(cumulative, size))
+            filled = cumulative[last - 1] if last > 0 else 0.0
+            cost = float(numpy.dot(prices[:last], sizes[:last])) + prices[last] * (size - filled)
+            return cost / size
+        remaining = size
+        cost = 0.0
+        for price, level in zip(prices, sizes):
+            take = min(level, remaining)
+            cost += price * take
+            remaining -= take
+            if remaining <= 0:
+                return cost / size
+        return None
+
+    def slippage(self, side, size):
+        """
+        How much worse than the best price filling size would be, as a fraction of the best price,
+        or None if the book is not deep enough.
+        """
+        prices, _ = self._side(side)
+        vwap = self.vwap(side, size)
+        if vwap is None:
+            return None
+        return abs(vwap - prices[0]) / prices[0]
@@ -1,39 +1,196 @@
+"""
+Listens to the Poloniex push feed, keeping redis tickers (and optionally order books) current.
+
+Importing the module has no side effects: redis, the plugin and logging are set up by setup(),
+which main() calls, so the listener starts quickly and can be imported cheaply.
+"""
 import datetime
 import json
+import logging
+from functools import partial
 
-from alchemyjsonschema.dictify import datetime_rfc3339
 from autobahn.twisted.wamp import ApplicationSession, ApplicationRunner
 from tapp_config import setup_redis, setup_logging
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+
+from poloniex_api import format_market
+from poloniex_book import BOOK_BLOB_KEY, BOOK_KEY, PUBLISH_DEPTH, BookGap, BookSnapshot, OrderBook
 
-from poloniex_manager import Poloniex
+BOOK_PUBLISH_INTERVAL = 0.25  # seconds between publishing changed books to redis
+TICKER_FLUSH_INTERVAL = 0.1  # seconds between writing changed tickers to redis
+SEED_RETRY = 1  # seconds before retrying a failed order book seed, doubling each time...
+SEED_RETRY_MAX = 60  # ... up to this
+TICKER_STATS_KEY = 'poloniex_listener_ticker_stats'
+MARKET_REFRESH_INTERVAL = 60 * 60  # seconds between checks that the market registry is current
 
-red = setup_redis()
+# set by setup()
+red = None
+poloniex = None
+logger = None
+tickers = None
 
 channels = {}
-poloniex = Poloniex()
-logger = setup_logging('poloniex_listener', prefix="trademanager", cfg=poloniex.cfg)
-poloniex.setup_connections()
-poloniex.setup_logger()  # will be actually use the logger above
+books = {}
+dirty_books = set()
+
+
+def setup():
+    """Connect to redis and the database, and set up logging. Only the first call does anything."""
+    global red, poloniex, logger, tickers
+    if poloniex is not None:
+        return
+    from poloniex_manager import Poloniex  # loads trade_manager and its models, so not on import
+    red = setup_redis()
+    poloniex = Poloniex()
+    logger = setup_logging('poloniex_listener', prefix="trademanager", cfg=poloniex.cfg)
+    poloniex.setup_connections()
+    poloniex.setup_logger()  # will be actually use the logger above
+    poloniex.market_registry  # load the cached symbol tables before the first ticker arrives
+    tickers = TickerWriter(red, poloniex.ticker_layout, logger)
+
+
+class TickerWriter(object):
+    """
+    Coalesces ticker messages: only the latest tick per market is kept, and the markets that changed
+    since the last flush are written to redis in a single pipeline, laid out as write_tickers' layout.
+
+    Counts ticks received, coalesced (overwritten before being written), written, and failed flushes.
+    """
+
+    def __init__(self, red, layout='keys', logger=None):
+        self.red = red
+        self.layout = layout
+        self.logger = logger if logger is not None else logging.getLogger('poloniex_listener')
+        self.latest = {}
+        self.received = 0
+        self.coalesced = 0
+        self.written = 0
+        self.errors = 0
+
+    def add(self, ticker):
+        """Keep a raw ticker message, as (message, time received), until the next flush."""
+        self.received += 1
+        if ticker[0] in self.latest:
+            self.coalesced += 1
+        self.latest[ticker[0]] = (ticker, datetime.datetime.utcnow())
+
+    def flush(self):
+        """
+        Write the changed markets' latest ticks. If redis fails they are kept for the next flush, unless
+        a newer tick arrives first, so the LoopingCall calling this never stops.
+        """
+        if len(self.latest) == 0:
+            return
+        from alchemyjsonschema.dictify import datetime_rfc3339
+        from poloniex_manager import write_tickers
+        latest, self.latest = self.latest, {}
+        jticks = {}
+        for ticker, received in latest.values():
+            market = format_market(ticker[0])
+            jticks[market] = json.dumps({
+                'bid': float(ticker[3]), 'ask': float(ticker[2]), 'last': float(ticker[1]),
+                'high': float(ticker[8]), 'low': float(ticker[9]), 'volume': float(ticker[6]),
+                'market': market, 'exchange': 'poloniex', 'time': datetime_rfc3339(received)})
+        self.written += len(latest)
+        try:
+            pipe = self.red.pipeline(transaction=False)
+            write_tickers(self.red, jticks, self.layout, pipe=pipe)
+            pipe.set(TICKER_STATS_KEY, json.dumps(self.stats()))
+            pipe.execute()
+        except Exception as e:
+            self.written -= len(latest)
+            self.errors += 1
+            for market, tick in latest.items():
+                self.latest.setdefault(market, tick)
+            self.logger.exception(e)
+            return
+        self.logger.debug("wrote %s poloniex tickers", len(latest))
+
+    def stats(self):
+        return {'received': self.received, 'coalesced': self.coalesced, 'written': self.written,
+                'errors': self.errors}
+
+
+def refresh_markets():
+    """Bring the market registry up to date off the reactor thread. A failure is logged, so the loop goes on."""
+    d = deferToThread(poloniex.refresh_markets)
+    d.addErrback(lambda failure: logger.error("unable to refresh poloniex markets: %s" % failure))
+    return d
 
 
 def on_ticker(*ticker):
-    market = poloniex.format_market(ticker[0])
-    jtick = {'bid': float(ticker[3]), 'ask': float(ticker[2]), 'last': float(ticker[1]), 'high': float(ticker[8]),
-             'low': float(ticker[9]), 'volume': float(ticker[6]),
-             'market': market, 'exchange': 'poloniex',
-             'time': datetime_rfc3339(datetime.datetime.utcnow())}
-    red.set('poloniex_%s_ticker' % market, json.dumps(jtick))
-    logger.debug("set poloniex %s ticker %s" % (market, jtick))
+    tickers.add(ticker)
+
+
+def seed_book(market, delay=0):
+    """
+    Fetch a returnOrderBook snapshot off the reactor thread, and load it into market's book.
+
+    A failed or bad snapshot is retried after a delay, doubling from SEED_RETRY up to SEED_RETRY_MAX seconds.
+    """
+    def retry():
+        from twisted.internet import reactor
+        wait = min(max(delay * 2, SEED_RETRY), SEED_RETRY_MAX)
+        reactor.callLater(wait, seed_book, market, wait)
+
+    def load(snapshot):
+        try:
+            books[market].load_snapshot(snapshot)
+            dirty_books.add(market)
+        except BookGap as e:
+            logger.warning(e)
+            seed_book(market)
+        except (KeyError, TypeError, ValueError):
+            logger.warning("bad poloniex %s order book snapshot %r" % (market, snapshot))
+            retry()
+
+    def failed(failure):
+        logger.error("unable to seed poloniex %s book: %s" % (market, failure))
+        retry()
+    d = deferToThread(poloniex.get_order_book, market)
+    d.addCallbacks(load, failed)
+    return d
+
+
+def on_book(market, *updates, **kwargs):
+    try:
+        books[market].apply(kwargs['seq'], updates)
+    except BookGap as e:
+        logger.warning(e)
+        seed_book(market)
+        return
+    dirty_books.add(market)
+
+
+def publish_books():
+    while dirty_books:
+        market = dirty_books.pop()
+        if books[market].seeded:
+            red.set(BOOK_KEY % market, json.dumps(books[market].snapshot(PUBLISH_DEPTH)))
+            red.set(BOOK_BLOB_KEY % market, BookSnapshot.from_book(books[market]).to_bytes())
 
 
 class PoloniexComponent(ApplicationSession):
     @inlineCallbacks
     def onJoin(self, details):
         yield self.subscribe(on_ticker, 'ticker')
+        LoopingCall(refresh_markets).start(MARKET_REFRESH_INTERVAL)
+        LoopingCall(tickers.flush).start(float(poloniex.get_option('ticker_flush_interval', TICKER_FLUSH_INTERVAL)))
+        for market in poloniex.get_option('book_markets', '').split(','):
+            market = market.strip()
+            if market == '':
+                continue
+            books[market] = OrderBook(market)
+            yield self.subscribe(partial(on_book, market), poloniex.unformat_market(market))
+            seed_book(market)
+        if len(books) > 0:
+            LoopingCall(publish_books).start(BOOK_PUBLISH_INTERVAL)
 
 
 def main():
+    setup()
     runner = ApplicationRunner(u"wss://api.poloniex.com:443", u"realm1")
     runner.run(PoloniexComponent)
 
@@ -1,62 +1,464 @@
 """
 Plugin for managing a Poloniex account.
 This module can be imported by trade_manager and used like a plugin.
+
+Importing it loads trade_manager, its sqlalchemy models and ledger. Code that only needs to convert
+market and currency symbols should use the functions in poloniex_api instead.
 """
 import datetime
+import functools
 import hashlib
 import hmac
 import json
+import os
+import signal
+import threading
 import time
 import urllib
-from ledger import Amount, Balance
-from requests import Timeout, get, post
-from requests.packages.urllib3.connection import ConnectionError
+from Queue import Empty, Queue
+from ledger import Amount
+from requests import RequestException, Timeout
 from sqlalchemy_models import jsonify2
 from trade_manager import em, wm
 from trade_manager.plugin import ExchangePluginBase, get_order_by_order_id, submit_order, get_orders
 
-baseUrl = 'https://poloniex.com/public?command='
-privUrl = 'https://poloniex.com/tradingApi'
+from poloniex_api import FileNonce, LocalNonce, Metrics, PoloniexTransport, RedisNonce, RequestScheduler, \
+    ResponseFingerprints, RowStream, CONCURRENT_NONCE_RETRIES, FINGERPRINT_TTL, MARKETS, MARKET_TTL, NONCE_RETRIES, \
+    POOL_SIZE, PRIORITIES, PRIORITY_BACKFILL, PRIORITY_SYNC, RATE_BURST, RATE_LIMIT, STREAM_CHUNK, UNCHANGED, \
+    baseUrl, batches, format_commodity, format_market, loads, parse_dates, privUrl, satoshi_str, to_satoshi, \
+    unformat_commodity, unformat_market
+from poloniex_book import BOOK_BLOB_KEY, BOOK_DEPTH, BOOK_KEY, PUBLISH_DEPTH, BookSnapshot, OrderBook
+from poloniex_profile import PROFILE_INTERVAL, PROFILE_SECONDS, SamplingProfiler
+
+IN_CHUNK = 500  # ids per SQL IN (...) lookup, well under sqlite's bound parameter limit
+COMMIT_CHUNK = 1000  # rows per transaction when bulk inserting history
+SYNC_OVERLAP = 60 * 60  # seconds of history re-read by incremental syncs
+POLONIEX_FOUNDED = 1389728364  # Jan 2014, the earliest any account history can start
+BACKFILL_WINDOW = 30 * 24 * 60 * 60  # seconds of history per parallel backfill window
+BACKFILL_WORKERS = 4
+TICKER_TTL = 1  # seconds a returnTicker download is reused for
+TICKER_KEY = 'poloniex_%s_ticker'  # one JSON string per market, the default "keys" layout
+TICKER_HASH = 'poloniex_tickers'  # one hash for every market, the "hash" layout
+TICKER_CHANNEL = 'poloniex_tickers'  # where the hash layout publishes each update
+ORDER_WORKERS = 8  # concurrent requests when cancelling or creating many orders at once
+METRICS_KEY = 'poloniex_metrics'  # JSON snapshot of Poloniex.metrics
+METRICS_TEXT_KEY = 'poloniex_metrics_text'  # the same, in the Prometheus text format
+METRICS_INTERVAL = 10  # seconds between metrics snapshots
+MARKET_RETRY = 60  # seconds before retrying a failed market registry refresh
+
+
+def known_ids(session, column, ids, chunk=IN_CHUNK):
+    """
+    Return the subset of ids already present in column, as a set.
+
+    Looks them up with one IN query per chunk of ids instead of one query per id.
+    """
+    ids = list(ids)
+    known = set()
+    for i in range(0, len(ids), chunk):
+        known.update(row[0] for row in session.query(column).filter(column.in_(ids[i:i + chunk])))
+    return known
+
+
+def load_by_ids(session, column, ids, chunk=IN_CHUNK):
+    """Return {id: row} for the rows of column's model whose column value is one of ids, chunked like known_ids."""
+    ids = list(ids)
+    rows = {}
+    for i in range(0, len(ids), chunk):
+        for row in session.query(column.class_).filter(column.in_(ids[i:i + chunk])):
+            rows[getattr(row, column.key)] = row
+    return rows
+
+
+def write_tickers(red, jticks, layout='keys', pipe=None):
+    """
+    Write {market: ticker JSON} to redis in one pipeline.
 
-REQ_TIMEOUT = 10  # seconds
+    The keys layout sets one key per market, as trade_manager's get_ticker expects. The hash layout sets
+    a field per market in TICKER_HASH, and publishes every update on TICKER_CHANNEL for readers to wait on.
+    Commands are queued on pipe if given, and left for the caller to execute.
+    """
+    execute = pipe is None
+    pipe = red.pipeline(transaction=False) if pipe is None else pipe
+    if layout == 'hash':
+        pipe.hmset(TICKER_HASH, jticks)
+        for jtick in jticks.values():
+            pipe.publish(TICKER_CHANNEL, jtick)
+    else:
+        pipe.mset(dict((TICKER_KEY % market, jticks[market]) for market in jticks))
+    if execute:
+        pipe.execute()
+
+
+def instrumented(f):
+    """Time a sync method with Poloniex.metrics, publishing a metrics snapshot when one is due."""
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        try:
+            with self.metrics.sync(f.__name__):
+                return f(self, *args, **kwargs)
+        finally:
+            self.publish_metrics()
+    return wrapper
+
+
+def db_time(f):
+    """Charge the time spent in a method to the database time of the sync calling it."""
+    @functools.wraps(f)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.db():
+            return f(self, *args, **kwargs)
+    return wrapper
 
 
 class Poloniex(ExchangePluginBase):
     NAME = 'poloniex'
     _user = None
+    _transport = None  # shared by every instance in the process
+    _scheduler = None  # ditto, since Poloniex rate limits per key
+    _nonces = None
+    _books = None
+    _ticker_cache = None  # (time fetched, returnTicker payload)
+    _fingerprints = None
+    _metrics = None
+    _metrics_published = 0
+    _profiler = None
+    _markets_loaded = False
+    _markets_attempted = 0  # when refresh_markets last asked poloniex
 
-    def submit_private_request(self, method, params=None, retry=0):
-        """Submit request to Poloniex"""
-        if params is None:
-            params = {}
+    def get_option(self, option, default=None):
+        """Read an optional setting from the [poloniex] section of the config, falling back to default."""
+        try:
+            return self.cfg.get(self.NAME, option)
+        except Exception:
+            return default
+
+    @property
+    def transport(self):
+        """
+        The pooled keep-alive HTTP transport used for every public and private request.
+
+        Configured by the optional pool_size, http2 and timeouts (e.g. "returnTradeHistory:60,buy:3")
+        settings.
+        """
+        if Poloniex._transport is None:
+            timeouts = {}
+            for pair in self.get_option('timeouts', '').split(','):
+                if ':' in pair:
+                    command, seconds = pair.split(':')
+                    timeouts[command.strip()] = float(seconds)
+            Poloniex._transport = PoloniexTransport(pool_size=int(self.get_option('pool_size', POOL_SIZE)),
+                                                    timeouts=timeouts,
+                                                    http2=self.get_option('http2', 'false').lower() == 'true')
+        return Poloniex._transport
+
+    @property
+    def scheduler(self):
+        """
+        The priority aware rate limiter every private request waits on.
+
+        Configured by the optional rate_limit (calls per second) and rate_burst settings.
+        """
+        if Poloniex._scheduler is None:
+            Poloniex._scheduler = RequestScheduler(rate=float(self.get_option('rate_limit', RATE_LIMIT)),
+                                                   burst=float(self.get_option('rate_burst', RATE_BURST)))
+        return Poloniex._scheduler
+
+    @property
+    def nonces(self):
+        """
+        The nonce allocator for this API key.
+
+        Set nonce_store to redis (default, safe across hosts sharing the redis), file (safe across processes
+        on one host, see nonce_file) or local (one process only).
+        """
+        if Poloniex._nonces is None:
+            store = self.get_option('nonce_store', 'redis')
+            if store == 'redis':
+                keyhash = hashlib.sha1(self.key).hexdigest()[:16]
+                Poloniex._nonces = RedisNonce(self.red, 'poloniex_%s_nonce' % keyhash)
+            elif store == 'file':
+                Poloniex._nonces = FileNonce(self.get_option('nonce_file',
+                                                             os.path.expanduser('~/.tapp/poloniex/nonce')))
+            else:
+                Poloniex._nonces = LocalNonce()
+        return Poloniex._nonces
+
+    @property
+    def fingerprints(self):
+        """
+        Fingerprints of the last responses processed by the polling syncs, so unchanged responses are skipped.
+
+        Fingerprints expire after the optional fingerprint_ttl setting (seconds); 0 disables skipping.
+        """
+        if Poloniex._fingerprints is None:
+            Poloniex._fingerprints = ResponseFingerprints(float(self.get_option('fingerprint_ttl', FINGERPRINT_TTL)))
+        return Poloniex._fingerprints
+
+    @property
+    def metrics(self):
+        """Request latency, error and per sync row and database time metrics for this process."""
+        if Poloniex._metrics is None:
+            Poloniex._metrics = Metrics()
+        return Poloniex._metrics
+
+    def publish_metrics(self, force=False):
+        """
+        Save a snapshot of the metrics, fingerprint hit rates and scheduler queues to redis, as JSON under
+        METRICS_KEY and as Prometheus text under METRICS_TEXT_KEY, at most every metrics_interval seconds.
+        """
+        now = time.time()
+        if not force and now - Poloniex._metrics_published < float(self.get_option('metrics_interval',
+                                                                                   METRICS_INTERVAL)):
+            return
+        Poloniex._metrics_published = now
+        snapshot = self.metrics.snapshot()
+        snapshot['fingerprints'] = self.fingerprints.stats()
+        snapshot['scheduler'] = self.scheduler.stats()
+        try:
+            pipe = self.red.pipeline(transaction=False)
+            pipe.set(METRICS_KEY, json.dumps(snapshot))
+            pipe.set(METRICS_TEXT_KEY, self.metrics.text())
+            pipe.execute()
+        except Exception as e:
+            self.logger.exception(e)
+
+    def profile(self, seconds=None):
+        """
+        Start a sampling profile of this process, unless one is running already (see poloniex_profile).
+
+        It runs for seconds (default the profile_seconds setting), then is written to the profile_dir setting.
+        :return: the SamplingProfiler
+        """
+        if Poloniex._profiler is not None and Poloniex._profiler.running:
+            return Poloniex._profiler
+        seconds = float(seconds or self.get_option('profile_seconds', PROFILE_SECONDS))
+        prefix = os.path.join(self.get_option('profile_dir', os.path.expanduser('~/.tapp/poloniex/profiles')),
+                              'poloniex-%s-%s' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.logger.info("poloniex profiling for %ss, to %s", seconds, prefix)
+        Poloniex._profiler = SamplingProfiler(prefix, seconds=seconds,
+                                              interval=float(self.get_option('profile_interval', PROFILE_INTERVAL)),
+                                              logger=self.logger).start()
+        return Poloniex._profiler
+
+    def toggle_profile(self, signum=None, frame=None):
+        """Start a profile, or end the running one early. Installed by main() as the SIGUSR1 handler."""
+        if Poloniex._profiler is not None and Poloniex._profiler.running:
+            Poloniex._profiler.stop()
+        else:
+            self.profile()
+
+    @property
+    def market_registry(self):
+        """
+        The market registry (poloniex_api.MARKETS) the symbol methods translate with and orders are checked
+        against, loaded from the market_cache file the first time it is used. Kept current by refresh_markets.
+        """
+        if not Poloniex._markets_loaded:
+            Poloniex._markets_loaded = True
+            path = self.market_cache
+            if os.path.exists(path):
+                try:
+                    MARKETS.read(path)
+                except (IOError, KeyError, ValueError) as e:
+                    self.logger.warning("poloniex unable to read market cache %s: %s", path, e)
+        return MARKETS
+
+    @property
+    def market_cache(self):
+        return self.get_option('market_cache', os.path.expanduser('~/.tapp/poloniex/markets.json'))
+
+    def refresh_markets(self, force=False):
+        """
+        Rebuild the market registry from returnTicker and returnCurrencies once it is more than market_ttl
+        seconds old, and save it to market_cache. A failed refresh is logged, not raised, and retried after
+        MARKET_RETRY seconds. Called by sync_tickers and the listener, never on the order path.
+
+        :return: the registry
+        """
+        registry = self.market_registry
+        now = time.time()
+        if not force and (now - Poloniex._markets_attempted < MARKET_RETRY or registry.updated is not None and
+                          now - registry.updated < float(self.get_option('market_ttl', MARKET_TTL))):
+            return registry
+        Poloniex._markets_attempted = now
+        try:
+            ticker = self.get_full_ticker()
+            currencies = self.submit_public_request('returnCurrencies')
+        except Exception as e:
+            self.logger.exception(e)
+            return registry
+        for resp in (ticker, currencies):
+            if not isinstance(resp, dict) or 'error' in resp:
+                self.logger.warning("poloniex unable to refresh markets: %r", resp)
+                return registry
+        registry.update(ticker, currencies, now)
+        try:
+            registry.save(self.market_cache)
+        except (IOError, OSError) as e:
+            self.logger.warning("poloniex unable to write market cache: %s", e)
+        return registry
+
+    def check_order(self, options):
+        """
+        Check buy/sell options against the market registry, so an order poloniex would refuse costs no request.
+
+        :return: a poloniex style {'error': reason} response, or None if the order may be sent
+        """
+        reason = self.market_registry.check_order(options['currencyPair'], options['rate'], options['amount'])
+        if reason is not None:
+            self.metrics.count('rejected', options['currencyPair'])
+            return {'error': reason}
+
+    @property
+    def books(self):
+        """Local order books kept by sync_book, by market."""
+        if self._books is None:
+            self._books = {}
+        return self._books
+
+    @property
+    def base_url(self):
+        return self.get_option('base_url', baseUrl)
+
+    @property
+    def priv_url(self):
+        return self.get_option('priv_url', privUrl)
+
+    @property
+    def sync_overlap(self):
+        """Seconds before the saved watermark that incremental syncs ask for again, to catch late arrivals."""
+        return float(self.get_option('sync_overlap', SYNC_OVERLAP))
+
+    def cursor_key(self, stream):
+        return 'poloniex_%s_%s_cursor' % (self.manager_user.id, stream)
+
+    def get_cursor(self, stream):
+        """The saved sync position of this account for stream (e.g. trades_all, ledgers), as a dict."""
+        cursor = self.red.get(self.cursor_key(stream))
+        return json.loads(cursor) if cursor else {}
+
+    def set_cursor(self, stream, **values):
+        """Update the saved sync position for stream. Values of None are removed."""
+        cursor = self.get_cursor(stream)
+        cursor.update(values)
+        cursor = dict((k, v) for k, v in cursor.items() if v is not None)
+        self.red.set(self.cursor_key(stream), json.dumps(cursor))
+
+    @db_time
+    def bulk_commit(self, objects, chunk=COMMIT_CHUNK):
+        """
+        Bulk insert objects, committing after every chunk so no single transaction stays open for long.
+
+        :return: False if any chunk failed to commit, and was rolled back
+        """
+        committed = True
+        for i in range(0, len(objects), chunk):
+            self.session.bulk_save_objects(objects[i:i + chunk])
+            try:
+                self.session.commit()
+            except Exception as e:
+                self.logger.exception(e)
+                self.session.rollback()
+                self.session.flush()
+                committed = False
+        return committed
+
+    def sign_request(self, method, params):
+        """Add the command and a fresh nonce to params, returning the encoded body and the signed headers."""
         params['command'] = method
-        params['nonce'] = int(time.time() * 1000)
+        params['nonce'] = self.nonces.next_nonce()
         data = urllib.urlencode(params)
         sign = hmac.new(self.secret, data, hashlib.sha512).hexdigest()
         headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
             'Sign': sign,
             'Key': self.key
         }
+        return data, headers
+
+    def decode_response(self, resp, fingerprint=None):
+        """
+        Parse a response body, or return UNCHANGED without parsing it if it is the same as the last body
+        fingerprinted under the key fingerprint. Errors are never fingerprinted.
+        """
+        if fingerprint is not None and self.fingerprints.unchanged(fingerprint, resp.content):
+            self.logger.debug("poloniex %s unchanged", fingerprint)
+            return UNCHANGED
+        try:
+            response = loads(resp.text)
+        except ValueError:
+            if fingerprint is not None:
+                self.fingerprints.forget(fingerprint)
+            raise
+        if fingerprint is not None and isinstance(response, dict) and 'error' in response:
+            self.fingerprints.forget(fingerprint)
+        return response
+
+    def submit_private_request(self, method, params=None, retry=0, priority=None, stream=False, fingerprint=None,
+                               retries=NONCE_RETRIES):
+        """
+        Submit request to Poloniex.
+
+        The request waits its turn in the rate limiter; priority defaults to the class of the command
+        (see poloniex_api.PRIORITIES), so cancels go before creates, before syncs and backfills.
+        With stream=True the body is not read up front: a poloniex_api.RowStream over it is returned instead.
+        With a fingerprint key, UNCHANGED is returned if the body is the same as last time (see decode_response).
+        A request refused for its nonce is signed again and resent, up to retries times.
+        """
+        if params is None:
+            params = {}
+        if priority is None:
+            priority = PRIORITIES.get(method, PRIORITY_SYNC)
+        self.scheduler.acquire(priority)
+        data, headers = self.sign_request(method, params)
         # self.logger.debug('sending to %s\nheaders: %s\ndata: %s' % (privUrl, headers, params))
+        tstart = time.time()
         try:
-            response = json.loads(post(url=privUrl, data=params,
-                                  headers=headers, timeout=REQ_TIMEOUT).text)
-        except (ConnectionError, Timeout, ValueError) as e:
+            if stream:
+                resp = self.transport.post(method, self.priv_url, data=data, headers=headers, stream=True)
+                response = RowStream(resp.iter_content(STREAM_CHUNK))
+                response.prime()
+            else:
+                response = self.decode_response(self.transport.post(method, self.priv_url, data=data,
+                                                                    headers=headers), fingerprint)
+        except Timeout as e:
+            self.metrics.count('timeout', method)
             self.logger.exception(e)
-        if "Invalid nonce" in response and retry < 3:
-            return self.submit_private_request(method, params=params, retry=retry + 1)
-        else:
-            return response
+            return None
+        except (RequestException, ValueError) as e:
+            self.metrics.count('error', method)
+            self.logger.exception(e)
+            return None
+        finally:
+            self.metrics.observe(method, time.time() - tstart)
+        if isinstance(response, (dict, RowStream)) and 'error' in response:
+            self.metrics.count('api_error', method)
+            if "Invalid nonce" in str(response.get('error')) and retry < retries:
+                self.metrics.count('nonce_retry', method)
+                return self.submit_private_request(method, params=params, retry=retry + 1, priority=priority,
+                                                   stream=stream, fingerprint=fingerprint, retries=retries)
+        return response
 
-    def submit_public_request(self, method, params=None):
+    def submit_public_request(self, method, params=None, fingerprint=None):
         params = params if params is not None else {}
-        if 'currencyPair' in params:
-            method += '&currencyPair=' + str(params['currencyPair'])
+        url = self.base_url + method
+        for param in params:
+            url += '&%s=%s' % (param, params[param])
+        tstart = time.time()
         try:
-            ret = get(baseUrl + method, timeout=REQ_TIMEOUT)
-        except (ConnectionError, Timeout) as e:
+            ret = self.transport.get(method, url)
+        except Timeout as e:
+            self.metrics.count('timeout', method)
             self.logger.exception(e)
-        return json.loads(ret.text)
+            return None
+        except RequestException as e:
+            self.metrics.count('error', method)
+            self.logger.exception(e)
+            return None
+        finally:
+            self.metrics.observe(method, time.time() - tstart)
+        return self.decode_response(ret, fingerprint)
 
     @classmethod
     def format_market(cls, market):
@@ -76,10 +478,7 @@ class Poloniex(ExchangePluginBase):
 
         :return: a market formatted according to what trade_manager expects.
         """
-        market = market.upper()
-        if 'USDT' in market:
-            market = market.replace('USDT', 'USD')
-        return "{1}_{0}".format(*market.split("_"))
+        return format_market(market)
 
     @classmethod
     def unformat_market(cls, market):
@@ -97,9 +496,7 @@ class Poloniex(ExchangePluginBase):
 
         :return: a market formated according to what poloniex expects.
         """
-        if 'USD' in market and not 'USDT' in market:
-            market = market.replace('USD', 'USDT')
-        return "{1}_{0}".format(*market.split("_"))
+        return unformat_market(market)
 
     @classmethod
     def format_commodity(cls, c):
@@ -109,7 +506,7 @@ class Poloniex(ExchangePluginBase):
         If the data provided by the exchange does not match the default
         implementation, then this method must be re-implemented.
         """
-        return c if c != 'USDT' else 'USD'
+        return format_commodity(c)
 
     @classmethod
     def unformat_commodity(cls, c):
@@ -118,20 +515,84 @@ class Poloniex(ExchangePluginBase):
         If the data provided by the exchange does not match the default
         implementation, then this method must be re-implemented.
         """
-        return c if c != 'USD' else 'USDT'
+        return unformat_commodity(c)
 
-    @classmethod
-    def sync_book(cls, market=None):
-        pass
+    @instrumented
+    def sync_book(self, market='BTC_USD', depth=BOOK_DEPTH):
+        """Seed market's local order book from a returnOrderBook snapshot, and publish it to redis."""
+        snapshot = self.get_order_book(market, depth)
+        if snapshot is None or 'error' in snapshot:
+            self.logger.warning("poloniex unable to get %s order book: %r" % (market, snapshot))
+            return
+        if market not in self.books:
+            self.books[market] = OrderBook(market)
+        self.books[market].load_snapshot(snapshot)
+        self.red.set(BOOK_KEY % market, json.dumps(self.books[market].snapshot(PUBLISH_DEPTH)))
+        self.red.set(BOOK_BLOB_KEY % market, BookSnapshot.from_book(self.books[market]).to_bytes())
+        return self.books[market]
+
+    def get_book_snapshots(self, markets):
+        """
+        The latest published BookSnapshot of each market, read from redis in one round trip.
+
+        :return: a dict of market: BookSnapshot, leaving out markets with nothing published
+        """
+        blobs = self.red.mget([BOOK_BLOB_KEY % market for market in markets])
+        return dict((market, BookSnapshot.from_bytes(blob)) for market, blob in zip(markets, blobs) if blob)
+
+    def get_full_ticker(self):
+        """
+        The returnTicker payload for every market, cached for ticker_ttl seconds
+        so that syncing many markets, or syncing repeatedly, costs one download.
+        """
+        now = time.time()
+        ttl = float(self.get_option('ticker_ttl', TICKER_TTL))
+        if Poloniex._ticker_cache is None or now - Poloniex._ticker_cache[0] > ttl:
+            full_ticker = self.submit_public_request('returnTicker', fingerprint='returnTicker')
+            if full_ticker is UNCHANGED and Poloniex._ticker_cache is not None:
+                full_ticker = Poloniex._ticker_cache[1]  # same payload, no need to parse it again
+            elif full_ticker is None or full_ticker is UNCHANGED or 'error' in full_ticker:
+                self.logger.warning("poloniex unable to get ticker: %r" % full_ticker)
+                return full_ticker
+            else:
+                self.market_registry.update_frozen(full_ticker)
+            Poloniex._ticker_cache = (now, full_ticker)
+        return Poloniex._ticker_cache[1]
 
+    @instrumented
     def sync_ticker(self, market='BTC_USD'):
-        self.logger.debug("getting poloniex %s market" % market)
-        pair = self.unformat_market(market)
-        self.logger.debug("getting poloniex %s pair" % pair)
-        full_ticker = self.submit_public_request('returnTicker')
-        self.logger.debug("poloniex %s full_ticker %s" % (market, full_ticker))
-        ticker = full_ticker[pair]
-        self.logger.debug("poloniex %s ticker %s" % (market, ticker))
+        self.logger.debug("getting poloniex %s market", market)
+        return self.apply_ticker(self.get_full_ticker(), market)
+
+    @instrumented
+    def sync_tickers(self, markets=None):
+        """
+        Sync the tickers of many markets (default every market) from a single returnTicker download,
+        writing them all to redis in one pipeline.
+
+        :return: a dict of market: em.Ticker
+        """
+        full_ticker = self.get_full_ticker()
+        if full_ticker is None or 'error' in full_ticker:
+            return {}
+        self.refresh_markets()
+        if markets is None:
+            markets = [self.format_market(pair) for pair in full_ticker]
+        ticks = {}
+        jticks = {}
+        for market in markets:
+            pair = self.unformat_market(market)
+            if pair not in full_ticker:
+                self.logger.warning("poloniex has no %s ticker" % market)
+                continue
+            ticks[market], jticks[market] = self.make_ticker(full_ticker[pair], market)
+        if len(jticks) > 0:
+            write_tickers(self.red, jticks, self.ticker_layout)
+        self.metrics.add_rows(len(jticks))
+        return ticks
+
+    def make_ticker(self, ticker, market):
+        """An em.Ticker, and its JSON, from one market's entry in a returnTicker response."""
         tick = em.Ticker(float(ticker['highestBid']),
                          float(ticker['lowestAsk']),
                          float(ticker['high24hr']),
@@ -139,79 +600,178 @@ class Poloniex(ExchangePluginBase):
                          float(ticker['quoteVolume']),
                          float(ticker['last']),
                          market, 'poloniex')
-        self.logger.debug("poloniex %s tick %s" % (market, tick))
-        jtick = jsonify2(tick, 'Ticker')
-        self.logger.debug("poloniex %s json ticker %s" % (market, jtick))
-        self.red.set('poloniex_%s_ticker' % market, jtick)
+        return tick, jsonify2(tick, 'Ticker')
+
+    def apply_ticker(self, full_ticker, market):
+        """Save market's ticker from a returnTicker response to redis. Returns None if it has no such ticker."""
+        if full_ticker is None or 'error' in full_ticker:
+            self.logger.warning("poloniex unable to get ticker: %r" % full_ticker)
+            return None
+        elif self.unformat_market(market) not in full_ticker:
+            self.logger.warning("poloniex has no %s ticker" % market)
+            return None
+        tick, jtick = self.make_ticker(full_ticker[self.unformat_market(market)], market)
+        self.logger.debug("poloniex %s json ticker %s", market, jtick)
+        write_tickers(self.red, {market: jtick}, self.ticker_layout)
+        self.metrics.add_rows(1)
         return tick
 
+    @property
+    def ticker_layout(self):
+        """How tickers are stored in redis, keys (default) or hash. See write_tickers."""
+        return self.get_option('ticker_layout', 'keys')
+
+    def get_tickers(self, markets):
+        """
+        The latest ticker of each market, read from redis in a single round trip.
+
+        :return: a dict of market: decoded ticker, leaving out markets with no ticker
+        """
+        if self.ticker_layout == 'hash':
+            jticks = self.red.hmget(TICKER_HASH, markets)
+        else:
+            jticks = self.red.mget([TICKER_KEY % market for market in markets])
+        return dict((market, json.loads(jtick)) for market, jtick in zip(markets, jticks) if jtick)
+
+    def ticker_updates(self):
+        """Yield every ticker update as it is published, decoded. Requires the hash layout."""
+        pubsub = self.red.pubsub()
+        pubsub.subscribe(TICKER_CHANNEL)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                yield json.loads(message['data'])
+
+    @instrumented
     def sync_balances(self):
-        data = self.submit_private_request('returnCompleteBalances')
-        # self.logger.debug("balances data: %s" % data)
-        available = Balance()
-        total = Balance()
+        """
+        Bring the user's wm.Balance rows in line with returnCompleteBalances.
+
+        All existing rows are loaded with one query, currencies that never held value are skipped,
+        and only rows whose total or available amount changed are written. Nothing at all is done
+        when the response is the same as the last one applied.
+        """
+        data = self.submit_private_request('returnCompleteBalances', fingerprint='returnCompleteBalances')
+        if data is UNCHANGED:
+            return
+        return self.apply_balances(data)
+
+    @db_time
+    def apply_balances(self, data):
+        """The database half of sync_balances, given a returnCompleteBalances response."""
+        if not data or 'error' in data:
+            self.logger.warning("poloniex unable to get balances: %r" % data)
+            return
+        self.metrics.add_rows(len(data))
+        bals = dict((bal.currency, bal) for bal in
+                    self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id))
+        changed = []
         for comm in data:
-            # self.logger.debug("comm: %s" % comm)
             commodity = self.format_commodity(comm)
-            aamount = Amount("{0:.8f} {1}".format(float(data[comm]['available']), commodity))
-            available = available + aamount
-            total = total + aamount + Amount("{0:.8f} {1}".format(float(data[comm]['onOrders']), commodity))
-        self.logger.debug("total balance: %s" % total)
-        self.logger.info("available balance: %s" % available)
-        bals = {}
-        for amount in total:
-            comm = str(amount.commodity)
-            bals[comm] = self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id) \
-                .filter(wm.Balance.currency == comm).one_or_none()
-            if not bals[comm]:
-                bals[comm] = wm.Balance(amount, available.commodity_amount(amount.commodity), comm, "",
-                                        self.manager_user.id)
-                self.session.add(bals[comm])
+            savailable = to_satoshi(data[comm]['available'])
+            stotal = savailable + to_satoshi(data[comm]['onOrders'])
+            bal = bals.get(commodity)
+            if bal is None and stotal == 0:
+                continue
+            available = Amount("%s %s" % (satoshi_str(savailable), commodity))
+            total = Amount("%s %s" % (satoshi_str(stotal), commodity))
+            if bal is None:
+                bal = wm.Balance(total, available, commodity, "", self.manager_user.id)
+                self.session.add(bal)
             else:
-                bals[comm].load_commodities()
-                bals[comm].total = amount or Amount("0 %s" % amount.commodity)
-                bals[comm].available = available.commodity_amount(amount.commodity) or Amount("0 %s" % amount.commodity)
+                bal.load_commodities()
+                if bal.total == total and bal.available == available:
+                    continue
+                bal.total = total
+                bal.available = available
+            changed.append(commodity)
+        if len(changed) == 0:
+            return
+        self.logger.info("balances changed: %s" % ", ".join(changed))
         try:
             self.session.commit()
         except Exception as e:
             self.logger.exception(e)
             self.session.rollback()
             self.session.flush()
+            self.fingerprints.forget('returnCompleteBalances')
 
+    @instrumented
     def sync_orders(self):
-        oorders = self.get_open_orders()
+        """Reconcile local open orders with returnOpenOrders, doing nothing if it is unchanged since the last sync."""
+        oorders = self.get_open_orders(skip_unchanged=True)
+        if oorders is UNCHANGED:
+            return
+        try:
+            self.close_vanished_orders(oorders)
+        except Exception:
+            self.fingerprints.forget('returnOpenOrders')
+            raise
+
+    @db_time
+    def close_vanished_orders(self, oorders):
+        """Close the locally open orders missing from oorders, the result of get_open_orders()."""
+        if oorders is None:
+            return
+        open_ids = set(o.order_id for o in oorders)
         dboorders = get_orders(exchange='poloniex', state='open', session=self.session)
         for dbo in dboorders:
-            if dbo not in oorders:
+            if dbo.order_id not in open_ids:
                 dbo.state = 'closed'
         self.session.commit()
 
-    @classmethod
-    def get_order_book(cls, market='BTC_USD'):
-        market = cls.unformat_market(market)
-        book = cls.submit_public_request('Depth', {'pair': market})
-        return book['result'][market]
+    def get_order_book(self, market='BTC_USD', depth=BOOK_DEPTH):
+        """The raw returnOrderBook snapshot for market: bids, asks and the push feed seq it is current to."""
+        return self.submit_public_request('returnOrderBook', {'currencyPair': self.unformat_market(market),
+                                                              'depth': depth})
 
     # private methods
-    def cancel_order(self, oid=None, order_id=None, order=None):
+    def find_order(self, oid=None, order_id=None, order=None):
         if order is None and oid is not None:
             order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
         elif order is None and order_id is not None:
             order = self.session.query(em.LimitOrder).filter(em.LimitOrder.order_id == order_id).first()
-        elif order is None:
+        return order
+
+    def cancel_order(self, oid=None, order_id=None, order=None):
+        order = self.find_order(oid, order_id, order)
+        if order is None:
             return
         resp = self.submit_private_request('cancelOrder', {'orderNumber': order.order_id.split("|")[1]})
-        if resp and 'success' in resp:
-            order.state = 'closed'
-            order.order_id = order.order_id.replace('tmp', 'poloniex')
+        self.apply_cancelled_order(order, resp)
+
+    def apply_cancelled_order(self, order, resp):
+        """The database half of cancel_order, given the cancelOrder response."""
+        self.apply_cancelled_orders([(order, resp)])
+
+    @db_time
+    def apply_cancelled_orders(self, results):
+        """Close every order whose cancelOrder response was a success, in one commit. Returns how many closed."""
+        cancelled = 0
+        for order, resp in results:
+            if resp and 'success' in resp:
+                order.state = 'closed'
+                order.order_id = order.order_id.replace('tmp', 'poloniex')
+                cancelled += 1
+            else:
+                self.logger.error("poloniex unable to cancel order %s, it may still be resting: %r",
+                                  order.order_id, resp)
+        if cancelled > 0:
+            # local orders changed, so the next returnOpenOrders must be applied even if it looks the same
+            self.fingerprints.forget('returnOpenOrders')
             try:
                 self.session.commit()
             except Exception as e:
                 self.logger.exception(e)
                 self.session.rollback()
                 self.session.flush()
+        return cancelled
 
     def cancel_orders(self, oid=None, order_id=None, market=None, side=None, price=None):
+        """
+        Cancel order oid or order_id, or else every open order matching market, side and price at once.
+
+        :return: for the latter, the number of orders cancelled and the seconds taken to get flat (see mass_cancel)
+        """
         if oid is not None or order_id is not None:
             order = self.session.query(em.LimitOrder)
             if oid is not None:
@@ -221,141 +781,342 @@ class Poloniex(ExchangePluginBase):
                 order = get_order_by_order_id(order_id, 'poloniex', session=self.session)
             self.cancel_order(order=order)
         else:
-            orders = self.get_open_orders(market=market)
-            for o in orders:
-                if market is not None and market != o.market:
+            return self.mass_cancel(self.select_orders(self.get_open_orders(market=market), market, side, price))
+
+    def concurrent_requests(self, requests, workers=None):
+        """
+        Send (method, params) private requests from a pool of worker threads, still within the scheduler's
+        rate budget. Workers never touch the database.
+
+        Concurrent requests can reach poloniex out of nonce order, so a request refused for its nonce is
+        signed again and resent up to CONCURRENT_NONCE_RETRIES times.
+
+        :return: the responses, in the order of requests; None for any request that raised
+        """
+        workers = workers or int(self.get_option('order_workers', ORDER_WORKERS))
+        pending = Queue()
+        for i, request in enumerate(requests):
+            pending.put((i, request))
+        responses = [None] * len(requests)
+
+        def worker():
+            while True:
+                try:
+                    i, (method, params) = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    responses[i] = self.submit_private_request(method, params, retries=CONCURRENT_NONCE_RETRIES)
+                except Exception as e:
+                    self.logger.exception(e)
+
+        threads = [threading.Thread(target=worker) for _ in range(min(workers, len(requests)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def mass_cancel(self, orders, workers=None):
+        """
+        Cancel orders concurrently on a pool of worker threads, still within the scheduler's rate budget,
+        then record every result with a single commit.
+
+        :return: the number of orders cancelled, and the seconds taken to get flat
+        """
+        tstart = time.time()
+        responses = self.concurrent_requests([('cancelOrder', {'orderNumber': o.order_id.split("|")[1]})
+                                              for o in orders], workers=workers)
+        cancelled = self.apply_cancelled_orders(zip(orders, responses))
+        elapsed = time.time() - tstart
+        self.logger.info("poloniex cancelled %s of %s orders, flat in %.3fs" % (cancelled, len(orders), elapsed))
+        return cancelled, elapsed
+
+    @staticmethod
+    def select_orders(orders, market=None, side=None, price=None):
+        """The orders matching the cancel_orders filters. Bids below and asks above price are left alone."""
+        selected = []
+        for o in orders or []:
+            if market is not None and market != o.market:
+                continue
+            if side is not None and side != o.side:
+                continue
+            if price is not None:
+                if o.side == 'bid' and o.price < price:
                     continue
-                if side is not None and side != o.side:
+                elif o.side == 'ask' and o.price > price:
                     continue
-                if price is not None:
-                    if o.side == 'bid' and o.price < price:
-                        continue
-                    elif o.side == 'ask' and o.price > price:
-                        continue
-                self.cancel_order(order=o)
+            selected.append(o)
+        return selected
 
-    def create_order(self, oid, expire=None):
-        order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
+    def prepare_order(self, oid, expire=None, order=None, loaded=False):
+        """
+        Load order oid, returning it with the buy/sell command and options to submit it with.
+
+        With loaded=True the caller has already looked order up (e.g. with load_by_ids), and None means
+        it was not found, so it is not queried again.
+        If the order is not found, it is requeued while expire has not passed, and (None, None, None) returned.
+        """
+        if order is None and not loaded:
+            order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
         if not order:
             self.logger.warning("unable to find order %s" % oid)
             if expire is not None and expire < time.time():
                 submit_order('poloniex', oid, expire=expire)  # back of the line!
-            return
+            return None, None, None
         market = self.unformat_market(order.market)
         amount = str(order.amount.number()) if isinstance(order.amount, Amount) else str(order.amount)
         price = str(order.price.number()) if isinstance(order.price, Amount) else str(order.price)
         side = 'buy' if order.side == 'bid' else 'sell'
-        options = {'amount': amount, 'rate': price, 'currencyPair': market}
+        return order, side, {'amount': amount, 'rate': price, 'currencyPair': market}
+
+    def create_order(self, oid, expire=None):
+        order, side, options = self.prepare_order(oid, expire)
+        if order is None:
+            return
         resp = None
         try:
-            resp = self.submit_private_request(side, options)
+            resp = self.check_order(options) or self.submit_private_request(side, dict(options))
         except Exception as e:
             self.logger.exception(e)
-        # self.logger.debug("create order resp %s" % resp)
-        if resp is None or 'error' in resp and len(resp['error']) > 0:
-            self.logger.warning('poloniex unable to create order %r for reason %r' % (options, resp))
-            # Do nothing. The order can stay locally "pending" and be retried, if desired.
-        elif 'orderNumber' in resp:
-            order.order_id = 'poloniex|%s' % resp['orderNumber']
-            order.state = 'open'
-            self.logger.debug("submitted order %s" % order)
+        return self.apply_created_order(order, options, resp)
+
+    def apply_created_order(self, order, options, resp):
+        """The database half of create_order, given the buy/sell response."""
+        created = self.apply_created_orders([(order, options, resp)])
+        return created[0] if len(created) > 0 else None
+
+    @db_time
+    def apply_created_orders(self, results):
+        """
+        Open every order whose buy/sell response carried an orderNumber, in one commit.
+
+        :param results: (order, options, response) tuples
+        :return: the orders opened
+        """
+        created = []
+        for order, options, resp in results:
+            # self.logger.debug("create order resp %s" % resp)
+            if resp is None or 'error' in resp and len(resp['error']) > 0:
+                self.logger.warning('poloniex unable to create order %r for reason %r' % (options, resp))
+                # Do nothing. The order can stay locally "pending" and be retried, if desired.
+            elif 'orderNumber' in resp:
+                order.order_id = 'poloniex|%s' % resp['orderNumber']
+                order.state = 'open'
+                self.logger.debug("submitted order %s", order)
+                created.append(order)
+        if len(created) > 0:
+            self.fingerprints.forget('returnOpenOrders')
             try:
                 self.session.commit()
             except Exception as e:
                 self.logger.exception(e)
                 self.session.rollback()
                 self.session.flush()
-            return order
+                return []
+        return created
+
+    def create_orders(self, oids, expire=None):
+        """
+        Submit many pending orders at once: one query to load them, concurrent requests, one commit.
+
+        :return: the orders opened
+        """
+        orders = load_by_ids(self.session, em.LimitOrder.id, oids)
+        prepared = [self.prepare_order(oid, expire, order=orders.get(oid), loaded=True) for oid in oids]
+        prepared = [p for p in prepared if p[0] is not None]
+        rejected = [self.check_order(options) for _, _, options in prepared]
+        sent = iter(self.concurrent_requests([(side, dict(options)) for (_, side, options), rejection
+                                              in zip(prepared, rejected) if rejection is None]))
+        return self.apply_created_orders([(order, options, rejection or next(sent))
+                                          for (order, _, options), rejection in zip(prepared, rejected)])
+
+    def replace_order(self, price, amount=None, oid=None, order_id=None, order=None):
+        """
+        Move an open order to a new price (and optionally amount) with a single moveOrder request,
+        instead of a cancel followed by a create.
+
+        moveOrder only moves the unfilled part of an order, so by default the new order is for the old
+        order's amount less its exec_amount. Any trades the move filled at once are its exec_amount.
+        The old order is closed and a new open order with poloniex's new orderNumber is returned,
+        or None if poloniex refused the move.
+        """
+        order = self.find_order(oid, order_id, order)
+        if order is None:
+            return
+        quote = self.quote_commodity(order.market)
+        base = self.base_commodity(order.market)
+        price = price if isinstance(price, Amount) else Amount("%s %s" % (price, quote))
+        remaining = order.amount - order.exec_amount if order.exec_amount is not None else order.amount
+        amount = remaining if amount is None else amount
+        amount = amount if isinstance(amount, Amount) else Amount("%s %s" % (amount, base))
+        params = {'orderNumber': order.order_id.split("|")[1], 'rate': str(price.number())}
+        if amount != remaining:
+            params['amount'] = str(amount.number())
+        resp = self.submit_private_request('moveOrder', params)
+        if not resp or 'orderNumber' not in resp:
+            self.logger.warning('poloniex unable to move order %r for reason %r' % (params, resp))
+            return
+        order.state = 'closed'
+        self.fingerprints.forget('returnOpenOrders')
+        fills = resp.get('resultingTrades') or []
+        if isinstance(fills, dict):  # keyed by currency pair
+            fills = [trade for trades in fills.values() for trade in trades]
+        filled = satoshi_str(sum(to_satoshi(trade['amount']) for trade in fills))
+        moved = em.LimitOrder(price, amount, order.market, order.side, self.NAME, resp['orderNumber'],
+                              exec_amount=Amount("%s %s" % (filled, base)), state='open')
+        self.session.add(moved)
+        try:
+            self.session.commit()
+        except Exception as e:
+            self.logger.exception(e)
+            self.session.rollback()
+            self.session.flush()
+            return
+        return moved
 
-    def get_open_orders(self, market=None):
+    def get_open_orders(self, market=None, skip_unchanged=False):
+        """
+        Get the open orders from poloniex as em.LimitOrders, adding any not yet known locally.
+
+        Known orders are looked up by order number in bulk, not one query per order.
+        Returns None if poloniex did not answer with a list of orders, and with skip_unchanged
+        returns UNCHANGED if the response is the same as the last one applied.
+        """
         pair = 'all' if market is None else self.unformat_market(market)
-        oorders = self.submit_private_request('returnOpenOrders', {'currencyPair': pair})
+        oorders = self.submit_private_request('returnOpenOrders', {'currencyPair': pair},
+                                              fingerprint='returnOpenOrders|%s' % pair if skip_unchanged else None)
+        if oorders is UNCHANGED:
+            return oorders
+        return self.apply_open_orders(oorders, market)
+
+    @db_time
+    def apply_open_orders(self, oorders, market=None):
+        """The database half of get_open_orders, given the returnOpenOrders response."""
         # self.logger.debug('open orders %s' % oorders)
+        if oorders is None or 'error' in oorders:
+            self.logger.warning("poloniex unable to get open orders: %r" % oorders)
+            return None
+        elif len(oorders) == 0:
+            return []
+        elif market is not None:
+            oorders = {self.unformat_market(market): oorders}
+        known = load_by_ids(self.session, em.LimitOrder.order_id,
+                            ['poloniex|%s' % porder['orderNumber'] for ppair in oorders for porder in oorders[ppair]])
         orders = []
-
-        def handle_market_orders(mppair, mporders):
-            for porder in mporders:
-                side = 'ask' if porder['type'] == 'sell' else 'bid'
-                pair = self.format_market(mppair)
-                base = self.base_commodity(pair)
-                amount = Amount("%s %s" % (porder['amount'], base))
-                quote = self.quote_commodity(pair)
-                try:
-                    lo = get_order_by_order_id(porder['orderNumber'], 'poloniex', session=self.session)
-                except Exception as e:
-                    self.logger.exception(e)
+        for ppair in oorders:
+            fpair = self.format_market(ppair)
+            base = self.base_commodity(fpair)
+            quote = self.quote_commodity(fpair)
+            for porder in oorders[ppair]:
+                lo = known.get('poloniex|%s' % porder['orderNumber'])
                 if lo is None:
-                    lo = em.LimitOrder(Amount("%s %s" % (porder['rate'], quote)), amount, pair, side,
+                    side = 'ask' if porder['type'] == 'sell' else 'bid'
+                    lo = em.LimitOrder(Amount("%s %s" % (porder['rate'], quote)),
+                                       Amount("%s %s" % (porder['amount'], base)), fpair, side,
                                        self.NAME, porder['orderNumber'], exec_amount=Amount("0 %s" % base),
                                        state='open')
                     self.session.add(lo)
-                else:
+                elif lo.state != 'open':
                     lo.state = 'open'
                 orders.append(lo)
-
-        if len(oorders) == 0:
-            return []
-        elif market is None:
-            for ppair in oorders:
-                handle_market_orders(ppair, oorders[ppair])
-        else:
-            handle_market_orders(pair, oorders)
+        self.metrics.add_rows(len(orders))
         try:
             self.session.commit()
         except Exception as e:
             self.logger.exception(e)
             self.session.rollback()
             self.session.flush()
+            self.fingerprints.forget('returnOpenOrders')
         return orders
 
-    def get_trades_history(self, begin=None, tend=None, market=None):
+    @property
+    def stream_history(self):
+        """Whether sync_trades and sync_credits parse history responses as a stream of rows (see RowStream)."""
+        return self.get_option('stream_history', 'true').lower() == 'true'
+
+    def get_trades_history(self, begin=None, tend=None, market=None, priority=None, stream=False):
         params = {'currencyPair': 'all' if market is None else self.unformat_market(market)
                   }
         if begin is not None:
             params['start'] = str(int(begin))
         if tend is not None:
             params['end'] = str(int(tend))
-        return self.submit_private_request('returnTradeHistory', params)
+        return self.submit_private_request('returnTradeHistory', params, priority=priority, stream=stream)
+
+    @db_time
+    def handle_trades(self, pair, trades, tend):
+        """
+        Add the unknown trades of one page of returnTradeHistory for pair.
 
+        :return: the earliest trade time seen (or tend if later), and whether any trade was added
+        """
+        changed = False
+        self.metrics.add_rows(len(trades))
+        known = known_ids(self.session, em.Trade.trade_id,
+                          ['poloniex|%s' % row['globalTradeID'] for row in trades])
+        new_trades = []
+        for row, (ftime, dtime) in zip(trades, parse_dates(trades)):
+            if ftime < tend:
+                tend = ftime
+            trade_id = 'poloniex|%s' % row['globalTradeID']
+            if trade_id in known:
+                self.logger.debug("%s already known", row['globalTradeID'])
+                continue
+            known.add(trade_id)
+            # market = self.format_market(row['pair'])
+            price = float(row['rate'])
+            amount = float(row['amount'])
+            fee = float(row['fee'])
+            feeside = 'quote'  # TODO this is wrong! port from old ledger function
+            side = row['type']
+            trade = em.Trade(row['globalTradeID'], 'poloniex', pair, side, amount, price, fee,
+                             feeside, dtime)
+            self.logger.debug("trade: %s", trade)
+            new_trades.append(trade)
+        if len(new_trades) > 0:
+            self.session.bulk_save_objects(new_trades)
+            changed = True
+        return tend, changed
+
+    def handle_trade_page(self, trades, market, tend):
+        """
+        handle_trades for every pair in a page of returnTradeHistory for market (None for all).
+
+        A streamed page is handled IN_CHUNK rows at a time, as they are parsed.
+        """
+        changed = False
+        if isinstance(trades, RowStream):
+            for pair, rows in batches(trades, IN_CHUNK):
+                tend, nchanged = self.handle_trades(pair=market if pair is None else self.format_market(pair),
+                                                    trades=rows, tend=tend)
+                changed = True if nchanged else changed
+        elif market is None:
+            for pair in trades:
+                tend, nchanged = self.handle_trades(pair=self.format_market(pair), trades=trades[pair], tend=tend)
+                changed = True if nchanged else changed
+        else:
+            tend, changed = self.handle_trades(pair=market, trades=trades, tend=tend)
+        return tend, changed
+
+    @instrumented
     def sync_trades(self, market=None, rescan=False):
-        tend = time.time()
+        """
+        Add new trades from poloniex to the database.
+
+        A normal sync only asks for trades since the saved watermark, less sync_overlap seconds.
+        rescan=True walks the whole history backwards a page at a time, committing and saving
+        its position after each page, so an interrupted backfill resumes where it stopped.
+        """
+        tstart = time.time()
+        begin, tend = self.start_trade_sync(market, rescan, tstart)
         lastend = tend - 1
         lastsleep = 4
-        allknown = False
-        changed = False
-        this = self
-
-        def handle_trades(pair, trades, tend):
-            changed = False
-            for row in trades:
-                ftime = time.mktime(time.strptime(row['date'], "%Y-%m-%d %H:%M:%S"))
-                dtime = datetime.datetime.fromtimestamp(ftime)
-                if ftime < tend:
-                    tend = ftime
-                    this.logger.info("new tend! %s" % tend)
-                found = this.session.query(em.Trade) \
-                    .filter(em.Trade.trade_id == 'poloniex|%s' % row['globalTradeID']) \
-                    .count()
-                if found != 0:
-                    this.logger.debug("%s already known" % row['globalTradeID'])
-                    continue
-                # market = self.format_market(row['pair'])
-                price = float(row['rate'])
-                amount = float(row['amount'])
-                fee = float(row['fee'])
-                feeside = 'quote'  # TODO this is wrong! port from old ledger function
-                side = row['type']
-                trade = em.Trade(row['globalTradeID'], 'poloniex', pair, side, amount, price, fee,
-                                 feeside, dtime)
-                this.logger.debug("trade: %s" % trade)
-                this.session.add(trade)
-                changed = True
-            return tend, changed
 
-        while tend != lastend:
+        while tend != lastend and (begin is None or tend > begin):
             lastend = tend
             try:
-                trades = self.get_trades_history(market=market, tend=tend)
+                trades = self.get_trades_history(begin=begin, market=market, tend=tend, stream=self.stream_history)
                 lastsleep *= 0.95
             except (IOError, ValueError) as e:
                 if "ReadTimeout" in str(e):
@@ -363,43 +1124,176 @@ class Poloniex(ExchangePluginBase):
                     time.sleep(lastsleep)
                     continue
                 return
-            if len(trades) == 0:
+            if trades is None or 'error' in trades:
+                self.logger.warning("poloniex unable to get trade history: %r" % trades)
+                return
+            elif not trades:
                 break
-            elif market is None:
-                for pair in trades:
-                    tend, nchanged = handle_trades(pair=self.format_market(pair), trades=trades[pair], tend=tend)
-                    changed = True if nchanged else changed
-            else:
-                tend, nchanged = handle_trades(pair=market, trades=trades, tend=tend)
-                changed = True if nchanged else changed
-            if not rescan:
+            try:
+                tend = self.apply_trade_page(trades, market, tend, rescan)
+            except (IOError, ValueError) as e:  # a streamed page broke off part way
+                self.logger.exception(e)
+                self.session.rollback()
+                return
+            if not rescan and begin is None:
                 break
+        self.finish_trade_sync(market, rescan, tstart)
+
+    def start_trade_sync(self, market, rescan, tstart):
+        """Work out the (begin, tend) range sync_trades should walk back through, from the saved cursor."""
+        stream = 'trades_%s' % (market or 'all')
+        cursor = self.get_cursor(stream)
+        if rescan:
+            if 'backfill' not in cursor:
+                self.set_cursor(stream, backfill=tstart, backfill_started=tstart)
+                cursor = self.get_cursor(stream)
+            self.logger.info("poloniex %s backfill from %s" % (stream, cursor['backfill']))
+            return None, cursor['backfill']
+        elif 'watermark' in cursor:
+            return cursor['watermark'] - self.sync_overlap, tstart
+        return None, tstart
+
+    def apply_trade_page(self, trades, market, tend, rescan):
+        """Add and commit one page of returnTradeHistory, saving the backfill position. Returns the new tend."""
+        tend, changed = self.handle_trade_page(trades, market, tend)
         if changed:
-            self.session.commit()
+            with self.metrics.db():
+                self.session.commit()
+        if rescan:
+            self.set_cursor('trades_%s' % (market or 'all'), backfill=tend)
+        return tend
+
+    def finish_trade_sync(self, market, rescan, tstart):
+        """Move the watermark once a sync_trades completes, and forget a finished backfill's position."""
+        stream = 'trades_%s' % (market or 'all')
+        if rescan:
+            cursor = self.get_cursor(stream)
+            self.set_cursor(stream, backfill=None, backfill_started=None,
+                            watermark=cursor.get('watermark', cursor.get('backfill_started', tstart)))
+        else:
+            self.set_cursor(stream, watermark=tstart)
 
-    def get_ledgers(self, begin=None, tend=None):
+    def fetch_trade_window(self, market, wstart, wend, pages):
+        """
+        Page backwards through returnTradeHistory from wend to wstart, putting every page on the pages queue.
+
+        Raises IOError if a page could not be fetched, so the window is counted as failed rather than done.
+        """
+        tend = wend
+        while True:
+            trades = self.get_trades_history(begin=wstart, tend=tend, market=market, priority=PRIORITY_BACKFILL)
+            if trades is None or 'error' in trades:
+                raise IOError("poloniex unable to get trade history from %s to %s: %r" % (wstart, tend, trades))
+            elif not trades:
+                return
+            pages.put(trades)
+            rows = trades if market is not None else [row for pair in trades for row in trades[pair]]
+            earliest = min(ftime for ftime, _ in parse_dates(rows))
+            if earliest >= tend or earliest <= wstart:
+                return
+            tend = earliest
+
+    @instrumented
+    def backfill_trades(self, market=None, begin=None, window=BACKFILL_WINDOW, workers=BACKFILL_WORKERS):
+        """
+        Fetch the whole trade history, split into time windows fetched concurrently by a pool of workers.
+
+        Workers only talk to poloniex, sharing the request scheduler's rate budget; pages are
+        de-duplicated and written to the database by the calling thread as they arrive.
+
+        :param begin: earliest time to fetch, defaults to the account_created setting or when poloniex was founded
+        :return: a dict of progress stats: windows, failed, trades, seconds and trades_per_sec
+        """
+        tstart = time.time()
+        begin = begin or float(self.get_option('account_created', POLONIEX_FOUNDED))
+        pending = Queue()
+        pages = Queue()
+        nwindows = 0
+        wend = tstart
+        while wend > begin:
+            pending.put((max(begin, wend - window), wend))
+            nwindows += 1
+            wend -= window
+        stats = {'windows': nwindows, 'failed': 0, 'trades': 0}
+
+        def worker():
+            while True:
+                try:
+                    wstart, wend = pending.get_nowait()
+                except Empty:
+                    return
+                try:
+                    self.fetch_trade_window(market, wstart, wend, pages)
+                except Exception as e:
+                    self.logger.exception(e)
+                    stats['failed'] += 1
+                pages.put(None)  # window done
+
+        threads = [threading.Thread(target=worker) for _ in range(min(workers, nwindows))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        done = 0
+        while done < nwindows:
+            page = pages.get()
+            if page is None:
+                done += 1
+                elapsed = time.time() - tstart
+                self.logger.info("poloniex backfill %s/%s windows, %s trades, %.0f trades/sec" %
+                                 (done, nwindows, stats['trades'], stats['trades'] / elapsed))
+                continue
+            _, changed = self.handle_trade_page(page, market, tstart)
+            stats['trades'] += len(page) if market is not None else sum(len(page[pair]) for pair in page)
+            if changed:
+                with self.metrics.db():
+                    self.session.commit()
+        for thread in threads:
+            thread.join()
+        stats['seconds'] = time.time() - tstart
+        stats['trades_per_sec'] = stats['trades'] / stats['seconds']
+        if stats['failed'] == 0:
+            stream = 'trades_%s' % (market or 'all')
+            self.set_cursor(stream, watermark=self.get_cursor(stream).get('watermark', tstart))
+        else:
+            self.logger.warning("poloniex backfill: %s of %s windows failed" % (stats['failed'], nwindows))
+        return stats
+
+    def get_ledgers(self, begin=None, tend=None, stream=False):
         params = {}
         if begin is not None:
             params['start'] = str(begin)
         else:
-            params['start'] = str(1389728364)  # Poloniex founded Jan 2014
+            params['start'] = str(POLONIEX_FOUNDED)
         if tend is not None:
             params['end'] = str(tend)
         else:
             params['end'] = str(time.time())
-        self.logger.debug("get dw params %s" % params)
-        return self.submit_private_request('returnDepositsWithdrawals', params)
+        self.logger.debug("get dw params %s", params)
+        return self.submit_private_request('returnDepositsWithdrawals', params, stream=stream)
 
+    @instrumented
     def sync_credits(self, rescan=False):
-        tend = time.time()
+        """
+        Add new deposits and withdrawals from poloniex to the database.
+
+        A normal sync only asks for ledger entries since the saved watermark, less sync_overlap seconds.
+        rescan=True asks for the whole account history. The watermark only moves once every page has been
+        fetched and committed, so a failed sync is retried from the same place next time.
+        """
+        tstart = time.time()
+        tend = tstart
         lastend = tend - 1
         lastsleep = 2
         changed = False
+        cursor = self.get_cursor('ledgers')
+        begin = None
+        if not rescan and 'watermark' in cursor:
+            begin = int(cursor['watermark'] - self.sync_overlap)
 
         while tend != lastend:
             lastend = tend
             try:
-                ledgers = self.get_ledgers(tend=tend)
+                ledgers = self.get_ledgers(begin=begin, tend=tend, stream=self.stream_history)
                 lastsleep *= 0.95
                 self.logger.debug(ledgers)
             except (IOError, ValueError) as e:
@@ -410,57 +1304,91 @@ class Poloniex(ExchangePluginBase):
                     continue
                 return
 
-            if len(ledgers) == 0:
+            if ledgers is None or 'error' in ledgers:
+                self.logger.warning("poloniex unable to get deposits and withdrawals: %r" % ledgers)
+                return
+            elif not ledgers:
                 break
-            for row in ledgers['deposits']:
-                if tend < float(row['timestamp']) and rescan:
-                    tend = float(row['timestamp'])
-                found = self.session.query(wm.Credit) \
-                    .filter(wm.Credit.ref_id == 'poloniex|%s' % row['txid']) \
-                    .count()
-                if found != 0:
-                    self.logger.debug("%s already known" % row['txid'])
-                    continue
-                self.logger.debug("%s not known" % row['txid'])
-                dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
-                asset = self.format_commodity(row['currency'])
-                amount = Amount("%s %s" % (row['amount'], asset))
-                refid = row['txid']
-                cred = wm.Credit(amount, row['address'], asset, "poloniex", "complete", refid,
-                                 "poloniex|%s" % row['txid'],
-                                 self.manager_user.id, dtime)
-                self.logger.debug("cred: %s" % cred)
-                self.session.add(cred)
-                changed = True
-            for row in ledgers['withdrawals']:
-                if tend < float(row['timestamp']) and rescan:
-                    tend = float(row['timestamp'])
-                found = self.session.query(wm.Credit) \
-                    .filter(wm.Credit.ref_id == 'poloniex|%s' % row['withdrawalNumber']) \
-                    .count()
-                if found != 0:
-                    self.logger.debug("%s already known" % row['withdrawalNumber'])
-                    continue
-                self.logger.debug("%s not known" % row['withdrawalNumber'])
-                dtime = datetime.datetime.fromtimestamp(float(row['timestamp']))
-                asset = self.format_commodity(row['currency'])
-                amount = Amount("%s %s" % (row['amount'], asset))
-                refid = row['status']
-                deb = wm.Debit(amount, Amount("0 %s" % asset), row['address'], asset, "poloniex", "complete", refid,
-                               "poloniex|%s" % row['withdrawalNumber'],
-                               self.manager_user.id, dtime)
-                self.logger.debug("deb: %s" % deb)
-                self.session.add(deb)
-                changed = True
-        self.logger.debug("changed? %s" % changed)
-        if changed:
-            self.session.commit()
+            if isinstance(ledgers, RowStream):
+                groups = batches(ledgers, IN_CHUNK)
+            else:
+                groups = [('deposits', ledgers.get('deposits', [])), ('withdrawals', ledgers.get('withdrawals', []))]
+            try:
+                for group, rows in groups:
+                    if rescan:
+                        for row in rows:
+                            if tend < float(row['timestamp']):
+                                tend = float(row['timestamp'])
+                    if group == 'deposits':
+                        new_rows = self.handle_deposits(rows)
+                    elif group == 'withdrawals':
+                        new_rows = self.handle_withdrawals(rows)
+                    else:
+                        continue
+                    if len(new_rows) > 0:
+                        if not self.bulk_commit(new_rows):
+                            return
+                        changed = True
+            except (IOError, ValueError) as e:  # a streamed response broke off part way
+                self.logger.exception(e)
+                return
+        self.logger.debug("changed? %s", changed)
+        self.set_cursor('ledgers', watermark=tstart)
 
     sync_debits = sync_credits
 
+    @db_time
+    def handle_deposits(self, deposits):
+        """wm.Credits for the deposits in a batch of returnDepositsWithdrawals rows that are not yet known."""
+        self.metrics.add_rows(len(deposits))
+        known = known_ids(self.session, wm.Credit.ref_id, ['poloniex|%s' % row['txid'] for row in deposits])
+        new_rows = []
+        for row in deposits:
+            if 'poloniex|%s' % row['txid'] in known:
+                self.logger.debug("%s already known", row['txid'])
+                continue
+            known.add('poloniex|%s' % row['txid'])
+            self.logger.debug("%s not known", row['txid'])
+            dtime = datetime.datetime.utcfromtimestamp(float(row['timestamp']))
+            asset = self.format_commodity(row['currency'])
+            amount = Amount("%s %s" % (row['amount'], asset))
+            refid = row['txid']
+            cred = wm.Credit(amount, row['address'], asset, "poloniex", "complete", refid,
+                             "poloniex|%s" % row['txid'],
+                             self.manager_user.id, dtime)
+            self.logger.debug("cred: %s", cred)
+            new_rows.append(cred)
+        return new_rows
+
+    @db_time
+    def handle_withdrawals(self, withdrawals):
+        """wm.Debits for the withdrawals in a batch of returnDepositsWithdrawals rows that are not yet known."""
+        self.metrics.add_rows(len(withdrawals))
+        known = known_ids(self.session, wm.Debit.ref_id,
+                          ['poloniex|%s' % row['withdrawalNumber'] for row in withdrawals])
+        new_rows = []
+        for row in withdrawals:
+            if 'poloniex|%s' % row['withdrawalNumber'] in known:
+                self.logger.debug("%s already known", row['withdrawalNumber'])
+                continue
+            known.add('poloniex|%s' % row['withdrawalNumber'])
+            self.logger.debug("%s not known", row['withdrawalNumber'])
+            dtime = datetime.datetime.utcfromtimestamp(float(row['timestamp']))
+            asset = self.format_commodity(row['currency'])
+            amount = Amount("%s %s" % (row['amount'], asset))
+            refid = row['status']
+            deb = wm.Debit(amount, Amount("0 %s" % asset), row['address'], asset, "poloniex", "complete", refid,
+                           "poloniex|%s" % row['withdrawalNumber'],
+                           self.manager_user.id, dtime)
+            self.logger.debug("deb: %s", deb)
+            new_rows.append(deb)
+        return new_rows
+
 
 def main():
     poloniex = Poloniex()
+    signal.signal(signal.SIGUSR1, poloniex.toggle_profile)  # kill -USR1 <pid> to profile a running plugin
+    signal.siginterrupt(signal.SIGUSR1, False)  # restart, rather than fail, the socket read it arrives in
     poloniex.run()
 
 
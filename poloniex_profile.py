@@ -0,0 +1,129 @@
+"""
+An on-demand sampling profiler for the long running plugin process.
+
+While running, a background thread samples the stack of every other thread at a fixed interval, for a
+fixed time. Each sample is attributed to the sync it was taken in and to a phase: waiting on the
+rate limiter, HTTP, JSON decoding, ORM work or commit. When the time is up, two files are written:
+
+    <prefix>.folded  one line per distinct stack and its sample count, the "collapsed" format read
+                     by flamegraph.pl and speedscope
+    <prefix>.json    seconds per sync and phase, plus wall clock and process CPU time
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+PROFILE_SECONDS = 60  # default length of a profile
+PROFILE_INTERVAL = 0.005  # seconds between samples
+
+# (phase, test on a frame's file name and function name), in order of precedence
+PHASES = (
+    ('commit', lambda path, name: name == 'commit' and 'sqlalchemy' in path),
+    ('orm', lambda path, name: 'sqlalchemy' in path),
+    ('json', lambda path, name: 'json' in path or (name == 'loads' and path.endswith('poloniex_api.py'))
+        or (name == '_value' and path.endswith('poloniex_api.py'))),
+    ('http', lambda path, name: 'requests' in path or 'urllib3' in path or 'httplib' in path
+        or os.path.join('http', 'client') in path or path.endswith(('socket.py', 'ssl.py'))),
+    ('rate_limit', lambda path, name: name == 'acquire' and path.endswith('poloniex_api.py')),
+)
+
+
+def frame_stack(frame):
+    """(file name, function name) of every frame in the stack ending at frame, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append((frame.f_code.co_filename, frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def classify(stack):
+    """The (sync, phase) a stack was sampled in. sync is the outermost sync_* method, or None."""
+    sync = None
+    for path, name in stack:
+        if path.endswith('poloniex_manager.py') and (name.startswith('sync_') or name == 'backfill_trades'):
+            sync = name
+            break
+    for phase, test in PHASES:
+        for path, name in stack:
+            if test(path, name):
+                return sync, phase
+    return sync, 'python'
+
+
+class SamplingProfiler(object):
+    """
+    Samples every thread's stack each interval seconds, for up to seconds, then writes the profile
+    to files starting with prefix.
+    """
+
+    def __init__(self, prefix, seconds=PROFILE_SECONDS, interval=PROFILE_INTERVAL, logger=None):
+        self.prefix = prefix
+        self.seconds = seconds
+        self.interval = interval
+        self.logger = logger
+        self.stacks = defaultdict(int)
+        self.phases = defaultdict(int)  # (sync, phase): samples
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='poloniex-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """End the profile early. It is still written."""
+        self._stop.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def _run(self):
+        own = threading.current_thread().ident
+        started = time.time()
+        cpu_started = sum(os.times()[:2])
+        deadline = started + self.seconds
+        while not self._stop.is_set() and time.time() < deadline:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = frame_stack(frame)
+                self.stacks[';'.join([names.get(ident, str(ident))] +
+                                     ['%s:%s' % (os.path.basename(path), name) for path, name in stack])] += 1
+                self.phases[classify(stack)] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+        self.write(time.time() - started, sum(os.times()[:2]) - cpu_started)
+
+    def write(self, wall_seconds, cpu_seconds):
+        """Write the .folded stacks and the .json summary, returning their paths."""
+        directory = os.path.dirname(self.prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        folded = self.prefix + '.folded'
+        with open(folded, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+        per_sample = wall_seconds / self.samples if self.samples else 0.0
+        summary = {'wall_seconds': wall_seconds, 'cpu_seconds': cpu_seconds, 'samples': self.samples,
+                   'interval': self.interval, 'syncs': {}}
+        for (sync, phase), count in self.phases.items():
+            summary['syncs'].setdefault(sync or 'other', {})[phase] = count * per_sample
+        path = self.prefix + '.json'
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+        if self.logger is not None:
+            self.logger.info("poloniex profile of %.1fs written to %s and %s", wall_seconds, folded, path)
+        return folded, path
@@ -9,7 +9,8 @@ classifiers = [
 setup(
     name='poloniex-manager',
     version='0.0.9',
-    py_modules=['poloniex_manager', 'poloniex_listener'],
+    py_modules=['poloniex_manager', 'poloniex_listener', 'poloniex_api', 'poloniex_async', 'poloniex_book',
+                'poloniex_profile'],
     url='https://github.com/gitguild/poloniex-manager',
     license='MIT',
     classifiers=classifiers,
@@ -0,0 +1,338 @@
+"""
+A local stand-in for poloniex.com, for benchmarks and offline tests.
+
+Serves the public?command= and tradingApi endpoints over plain HTTP/1.1 with keep-alive,
+with configurable latency, error rate and data volume. ticker_feed() stands in for the
+WAMP push feed, producing the same ticker messages the listener subscribes to.
+
+    stub = StubExchange(latency=0.005, trades=100000)
+    stub.start()
+    ... point the plugin's base_url / priv_url at stub.base_url / stub.priv_url ...
+    stub.stop()
+"""
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:  # python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+TICKER = {
+    'USDT_BTC': {'last': '600.00000000', 'lowestAsk': '600.10000000', 'highestBid': '599.90000000',
+                 'percentChange': '0.01', 'baseVolume': '100000.0', 'quoteVolume': '170.0',
+                 'isFrozen': '0', 'high24hr': '610.00000000', 'low24hr': '590.00000000'},
+    'BTC_ETH': {'last': '0.02000000', 'lowestAsk': '0.02001000', 'highestBid': '0.01999000',
+                'percentChange': '0.01', 'baseVolume': '1000.0', 'quoteVolume': '50000.0',
+                'isFrozen': '0', 'high24hr': '0.02100000', 'low24hr': '0.01900000'},
+}
+
+
+CURRENCIES = ['BTC', 'USDT', 'ETH', 'LTC', 'DASH', 'XMR', 'ZEC', 'ETC']
+
+
+def make_markets(n):
+    """TICKER plus synthetic markets up to n, for ticker and order book volume."""
+    markets = dict(TICKER)
+    for i in range(len(markets), n):
+        markets['BTC_X%03d' % i] = dict(TICKER['BTC_ETH'])
+    return markets
+
+
+def make_currencies(n):
+    """A returnCurrencies response for n currencies."""
+    currencies = {}
+    for i in range(n):
+        currency = CURRENCIES[i] if i < len(CURRENCIES) else 'X%03d' % i
+        currencies[currency] = {'id': i + 1, 'name': currency, 'txFee': '0.00010000', 'minConf': 6,
+                                'depositAddress': None, 'disabled': 0, 'delisted': 0, 'frozen': 0}
+    return currencies
+
+
+def make_balances(n):
+    """A returnCompleteBalances response for n currencies, the first few of them non-zero."""
+    balances = {}
+    for i in range(n):
+        currency = CURRENCIES[i] if i < len(CURRENCIES) else 'X%03d' % i
+        held = i < 4
+        balances[currency] = {'available': '1.50000000' if held else '0.00000000',
+                              'onOrders': '0.25000000' if held else '0.00000000',
+                              'btcValue': '0.10000000' if held else '0.00000000'}
+    return balances
+
+
+def make_ledgers(n, now=None, spacing=3600):
+    """n synthetic returnDepositsWithdrawals rows, alternating deposits and withdrawals."""
+    now = int(now or time.time())
+    ledgers = {'deposits': [], 'withdrawals': []}
+    for i in range(n):
+        stamp = now - i * spacing
+        if i % 2:
+            ledgers['withdrawals'].append({'withdrawalNumber': 500000 + i, 'currency': 'BTC', 'amount': '0.50000000',
+                                           'address': '1stubaddress%s' % i, 'timestamp': stamp,
+                                           'status': 'COMPLETE: stubtx%s' % i})
+        else:
+            ledgers['deposits'].append({'txid': 'stubtx%s' % i, 'currency': 'BTC', 'amount': '1.00000000',
+                                        'address': '1stubaddress%s' % i, 'timestamp': stamp,
+                                        'confirmations': 6, 'status': 'COMPLETE'})
+    return ledgers
+
+
+def make_book(depth, mid=600.0, tick=0.1):
+    """A returnOrderBook response with depth levels a side around mid."""
+    return {'bids': [['%.8f' % (mid - tick * (i + 1)), '%.8f' % (0.1 * (i + 1))] for i in range(depth)],
+            'asks': [['%.8f' % (mid + tick * (i + 1)), '%.8f' % (0.1 * (i + 1))] for i in range(depth)],
+            'isFrozen': '0', 'seq': 1}
+
+
+def ticker_feed(n, markets=None):
+    """
+    Yield n push feed ticker messages, as the positional arguments the listener's on_ticker is called with:
+    currencyPair, last, lowestAsk, highestBid, percentChange, baseVolume, quoteVolume, isFrozen, 24hrHigh, 24hrLow.
+    """
+    markets = sorted(markets or TICKER)
+    for i in range(n):
+        pair = markets[i % len(markets)]
+        last = 600.0 + (i % 100) * 0.01
+        yield (pair, '%.8f' % last, '%.8f' % (last + 0.1), '%.8f' % (last - 0.1), '0.01', '100000.0', '170.0', 0,
+               '610.00000000', '590.00000000')
+
+
+class StubOrder(object):
+    """Stands in for an em.LimitOrder resting on the stub, for tests that leave the database out."""
+
+    def __init__(self, order_number, market='BTC_USD', side='bid', price=600):
+        self.order_id = 'poloniex|%s' % order_number
+        self.market = market
+        self.side = side
+        self.price = price
+        self.state = 'open'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like poloniex.com
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+        time.sleep(stub.latency)
+        self._reply(stub.maybe_fail() or stub.public(query.get('command'), query))
+
+    def do_POST(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length', 0))
+        params = dict((k, v[0]) for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items())
+        time.sleep(stub.latency)
+        self._reply(stub.maybe_fail() or stub.private(params.get('command'), params))
+
+
+def make_trades(n, pair='USDT_BTC', now=None, spacing=10):
+    """n synthetic returnTradeHistory rows, newest first, one every spacing seconds."""
+    now = int(now or time.time())
+    trades = []
+    for i in range(n):
+        stamp = now - i * spacing
+        trades.append({'globalTradeID': 1000000 + n - i, 'tradeID': str(n - i),
+                       'date': time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(stamp)),
+                       'rate': '600.00000000', 'amount': '0.01000000', 'total': '6.00000000',
+                       'fee': '0.00150000', 'orderNumber': str(2000000 + n - i),
+                       'type': 'buy' if i % 2 else 'sell', 'category': 'exchange', '_stamp': stamp})
+    return pair, trades
+
+
+class StubExchange(object):
+    """
+    :param latency: seconds to sleep before answering each request
+    :param trades: how many synthetic trades returnTradeHistory has to page through
+    :param page_size: maximum rows returned by one returnTradeHistory call
+    :param error_rate: fraction of requests answered with a poloniex style error instead
+    :param markets: how many markets returnTicker lists
+    :param currencies: how many currencies returnCompleteBalances and returnCurrencies list
+    :param ledgers: how many deposits and withdrawals returnDepositsWithdrawals returns
+    :param book_depth: levels per side in returnOrderBook
+    """
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, trades=0, page_size=10000, error_rate=0.0,
+                 markets=2, currencies=8, ledgers=0, book_depth=50):
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.errors = 0
+        self.trade_pair, self.trades = make_trades(trades)
+        self.markets = make_markets(markets)
+        self.balances = make_balances(currencies)
+        self.currencies = make_currencies(currencies)
+        self.ledgers = make_ledgers(ledgers)
+        self.book = make_book(book_depth)
+        self.server = _ThreadingHTTPServer((host, port), StubHandler)
+        self.server.stub = self
+        self.thread = None
+        self.requests = 0
+        self.last_nonce = 0
+        self.nonce_errors = 0
+        self.orders = {}  # orderNumber: (pair, returnOpenOrders row)
+        self._order_numbers = itertools.count(3000000)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://%s:%s/public?command=' % self.server.server_address
+
+    @property
+    def priv_url(self):
+        return 'http://%s:%s/tradingApi' % self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def maybe_fail(self):
+        """An error response for error_rate of the requests, otherwise None."""
+        if self.error_rate > 0 and random.random() < self.error_rate:
+            self.errors += 1
+            return {'error': 'Internal error. Please try again.'}
+
+    def public(self, command, params):
+        self.requests += 1
+        if command == 'returnTicker':
+            return self.markets
+        elif command == 'returnCurrencies':
+            return self.currencies
+        elif command == 'returnOrderBook':
+            return self.book
+        return {'error': 'Invalid command.'}
+
+    def private(self, command, params):
+        self.requests += 1
+        nonce = int(params.get('nonce', 0))
+        with self._lock:
+            if nonce <= self.last_nonce:
+                self.nonce_errors += 1
+                return {'error': 'Invalid nonce parameter. Nonce must be greater than %s.' % self.last_nonce}
+            self.last_nonce = nonce
+        if command == 'returnTradeHistory':
+            return self.trade_history(params)
+        elif command in ('buy', 'sell'):
+            return {'orderNumber': self.add_order(params['currencyPair'], command, params['rate'], params['amount']),
+                    'resultingTrades': []}
+        elif command == 'cancelOrder':
+            with self._lock:
+                if self.orders.pop(params['orderNumber'], None) is None:
+                    return {'error': 'Invalid order number, or you are not the person who placed the order.'}
+            return {'success': 1}
+        elif command == 'moveOrder':
+            with self._lock:
+                moved = self.orders.pop(params['orderNumber'], None)
+            if moved is None:
+                return {'error': 'Invalid order number, or you are not the person who placed the order.'}
+            pair, row = moved
+            return {'success': 1, 'resultingTrades': {},
+                    'orderNumber': self.add_order(pair, row['type'], params['rate'],
+                                                  params.get('amount', row['amount']))}
+        elif command == 'returnOpenOrders':
+            return self.open_orders(params['currencyPair'])
+        elif command == 'returnCompleteBalances':
+            return self.balances
+        elif command == 'returnDepositsWithdrawals':
+            start = float(params.get('start', 0))
+            end = float(params.get('end', time.time()))
+            return dict((kind, [row for row in rows if start <= row['timestamp'] <= end])
+                        for kind, rows in self.ledgers.items())
+        return {'error': 'Invalid command.'}
+
+    def add_order(self, pair, side, rate, amount):
+        """Rest an order on the stub, returning its orderNumber."""
+        with self._lock:
+            order_number = str(next(self._order_numbers))
+            self.orders[order_number] = (pair, {'orderNumber': order_number, 'type': side, 'rate': str(rate),
+                                                'amount': str(amount), 'total': str(float(rate) * float(amount))})
+        return order_number
+
+    def fill(self, order_number, amount):
+        """Fill amount of a resting order, as a trade against it would."""
+        with self._lock:
+            row = self.orders[order_number][1]
+            row['amount'] = '%.8f' % (float(row['amount']) - float(amount))
+
+    def open_orders(self, pair):
+        with self._lock:
+            orders = list(self.orders.values())
+        if pair != 'all':
+            return [row for opair, row in orders if opair == pair]
+        grouped = {}
+        for opair, row in orders:
+            grouped.setdefault(opair, []).append(row)
+        return grouped
+
+    def trade_history(self, params):
+        start = float(params.get('start', 0))
+        end = float(params.get('end', time.time()))
+        page = [dict((k, v) for k, v in t.items() if k != '_stamp') for t in self.trades
+                if start <= t['_stamp'] <= end][:self.page_size]
+        if params.get('currencyPair') == 'all':
+            return {self.trade_pair: page} if page else []
+        return page if params.get('currencyPair') == self.trade_pair else []
+
+
+def reset_plugin():
+    """Drop the Poloniex plugin's process wide transport, scheduler, caches and market registry."""
+    import poloniex_api
+    from poloniex_manager import Poloniex
+    Poloniex._transport = Poloniex._scheduler = Poloniex._nonces = Poloniex._books = None
+    Poloniex._fingerprints = Poloniex._metrics = Poloniex._ticker_cache = None
+    Poloniex._markets_loaded = False
+    Poloniex._markets_attempted = 0
+    poloniex_api.MARKETS.load({}, {}, None)
+
+
+def stub_plugin(stub, **options):
+    """
+    A Poloniex plugin wired to the given StubExchange instead of poloniex.com, with any extra settings.
+
+    The settings only apply to the returned instance, but the plugin's process wide state is reset, so
+    call reset_plugin() before using other instances again. The database is the one configured in
+    ~/.tapp/poloniex/cfg.ini, as with the test suite.
+    """
+    import tempfile
+    from poloniex_manager import Poloniex
+    plugin = Poloniex()
+    plugin.setup_connections()
+    plugin.setup_logger()
+    settings = {'base_url': stub.base_url, 'priv_url': stub.priv_url, 'nonce_store': 'local',
+                'rate_limit': '10000', 'rate_burst': '10000',
+                'market_cache': os.path.join(tempfile.gettempdir(), 'poloniex-stub-markets-%s.json' % os.getpid())}
+    settings.update((option, str(value)) for option, value in options.items())
+    get_option = plugin.get_option
+    plugin.get_option = lambda option, default=None: settings[option] if option in settings \
+        else get_option(option, default)
+    reset_plugin()
+    return plugin
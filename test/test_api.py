@@ -0,0 +1,166 @@
+import calendar
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+from poloniex_api import MarketRegistry, Metrics, PoloniexTransport, RequestScheduler, ResponseFingerprints, \
+    REQ_TIMEOUT, PRIORITY_BACKFILL, PRIORITY_CANCEL, parse_date, satoshi_str, to_satoshi
+from test.stub_exchange import StubExchange, TICKER, make_currencies, ticker_feed
+
+
+def test_transport_timeouts():
+    transport = PoloniexTransport(timeouts={'returnTradeHistory': 60})
+    assert transport.timeout('returnTradeHistory')[1] == 60
+    assert transport.timeout('cancelOrder')[1] == 5
+    assert transport.timeout('returnCompleteBalances')[1] == REQ_TIMEOUT
+
+
+def test_transport_reuses_connection():
+    stub = StubExchange().start()
+    try:
+        transport = PoloniexTransport(pool_size=1)
+        for _ in range(3):
+            resp = transport.get('returnTicker', stub.base_url + 'returnTicker')
+            assert 'USDT_BTC' in json.loads(resp.text)
+        pool = transport.session.get_adapter(stub.base_url).poolmanager.connection_from_url(stub.base_url)
+        assert pool.num_connections == 1
+    finally:
+        stub.stop()
+
+
+def test_stub_endpoints():
+    stub = StubExchange(currencies=20, ledgers=10, book_depth=5, markets=30).start()
+    try:
+        transport = PoloniexTransport()
+
+        def private(command, **params):
+            params.update({'command': command, 'nonce': int(time.time() * 1000000)})
+            return json.loads(transport.post(command, stub.priv_url, data=params, headers={}).text)
+
+        assert len(private('returnCompleteBalances')) == 20
+        ledgers = private('returnDepositsWithdrawals', start=0, end=time.time() + 1)
+        assert len(ledgers['deposits']) + len(ledgers['withdrawals']) == 10
+        book = json.loads(transport.get('returnOrderBook', stub.base_url + 'returnOrderBook').text)
+        assert len(book['bids']) == len(book['asks']) == 5
+        assert len(json.loads(transport.get('returnTicker', stub.base_url + 'returnTicker').text)) == 30
+        assert len(json.loads(transport.get('returnCurrencies', stub.base_url + 'returnCurrencies').text)) == 20
+        stub.error_rate = 1.0
+        assert 'error' in private('returnCompleteBalances')
+        assert stub.errors == 1
+    finally:
+        stub.stop()
+    assert [message[0] for message in ticker_feed(3)] == ['BTC_ETH', 'USDT_BTC', 'BTC_ETH']
+
+
+def test_scheduler_priority():
+    scheduler = RequestScheduler(rate=20, burst=1)
+    scheduler.acquire(PRIORITY_BACKFILL)  # drain the bucket
+    order = []
+
+    def worker(priority):
+        scheduler.acquire(priority)
+        order.append(priority)
+
+    threads = [threading.Thread(target=worker, args=(PRIORITY_BACKFILL,)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.01)
+    cancel = threading.Thread(target=worker, args=(PRIORITY_CANCEL,))
+    cancel.start()
+    for t in threads + [cancel]:
+        t.join()
+    assert order.index(PRIORITY_CANCEL) <= 1
+    stats = scheduler.stats()
+    assert stats['granted'][PRIORITY_BACKFILL] == 4
+    assert stats['depth'][PRIORITY_CANCEL] == 0
+
+
+def test_to_satoshi():
+    assert to_satoshi('0.00150000') == 150000
+    assert to_satoshi('600.1') == 60010000000
+    assert to_satoshi('-0.00000001') == -1
+    assert to_satoshi('12') == 1200000000
+    assert to_satoshi('1e-8') == 1
+    assert to_satoshi(0.1) == 10000000
+    assert satoshi_str(150000) == '0.00150000'
+    assert satoshi_str(-1) == '-0.00000001'
+    assert satoshi_str(to_satoshi('123.45678901')) == '123.45678901'
+
+
+def test_parse_date():
+    stamp, dtime = parse_date('2016-05-01 12:34:56')
+    assert stamp == calendar.timegm(time.strptime('2016-05-01 12:34:56', "%Y-%m-%d %H:%M:%S"))
+    assert dtime == datetime.datetime(2016, 5, 1, 12, 34, 56)
+    assert parse_date('2016-05-01 00:00:00')[0] == stamp - (12 * 3600 + 34 * 60 + 56)
+
+
+def test_fingerprints():
+    fingerprints = ResponseFingerprints(ttl=60)
+    assert not fingerprints.unchanged('returnOpenOrders|all', b'{"USDT_BTC": []}')
+    assert fingerprints.unchanged('returnOpenOrders|all', b'{"USDT_BTC": []}')
+    assert not fingerprints.unchanged('returnOpenOrders|all', b'{"BTC_ETH": []}')
+    fingerprints.forget('returnOpenOrders')
+    assert not fingerprints.unchanged('returnOpenOrders|all', b'{"BTC_ETH": []}')
+    stats = fingerprints.stats()['returnOpenOrders|all']
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 3, 0.25)
+    disabled = ResponseFingerprints(ttl=0)
+    assert not disabled.unchanged('returnTicker', b'{}')
+    assert not disabled.unchanged('returnTicker', b'{}')
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.observe('returnTicker', 0.003)
+    metrics.observe('returnTicker', 0.2)
+    metrics.count('timeout', 'returnTradeHistory')
+    with metrics.sync('sync_trades'):
+        metrics.add_rows(500)
+        with metrics.db():
+            with metrics.db():
+                time.sleep(0.01)
+    with pytest.raises(ValueError):
+        with metrics.sync('sync_balances'):
+            raise ValueError()
+    snapshot = metrics.snapshot()
+    assert snapshot['requests']['returnTicker']['count'] == 2
+    assert snapshot['requests']['returnTicker']['p50'] == 0.005
+    assert snapshot['counters'] == {'timeout': {'returnTradeHistory': 1}, 'error': {'sync_balances': 1}}
+    assert snapshot['rows'] == {'sync_trades': 500}
+    assert 0.01 <= snapshot['db_seconds']['sync_trades'] < 0.1
+    assert metrics.current is None
+    text = metrics.text()
+    assert 'poloniex_request_seconds_bucket{command="returnTicker",le="+Inf"} 2' in text
+    assert 'poloniex_rows_total{sync="sync_trades"} 500' in text
+
+
+def test_market_registry(tmpdir):
+    registry = MarketRegistry()
+    assert registry.format_market('USDT_BTC') == 'BTC_USD'  # by rule, before the registry is built
+    assert registry.check_order('BTC_NOPE', '1', '1') is None
+    ticker = dict(TICKER, BTC_XMR=dict(TICKER['BTC_ETH'], isFrozen='1'))
+    registry.update(ticker, make_currencies(8), updated=1000)
+    assert registry.format_market('BTC_ETH') == 'ETH_BTC'
+    assert registry.unformat_market('BTC_USD') == 'USDT_BTC'
+    assert registry.format_commodity('USDT') == 'USD'
+    assert registry.unformat_commodity('USD') == 'USDT'
+    assert registry.check_order('USDT_BTC', '600.00000000', '0.01') is None
+    assert registry.check_order('BTC_ETH', '0.02', '0.005') is None
+    assert 'Total must be at least 1.0' in registry.check_order('USDT_BTC', '600', '0.001')
+    assert 'Total must be at least' in registry.check_order('BTC_ETH', '0.02', '0.001')
+    assert 'decimal places' in registry.check_order('BTC_ETH', '0.020000001', '1')
+    assert 'decimal places' not in (registry.check_order('BTC_ETH', '0.02', 1e-05) or '')
+    assert 'frozen' in registry.check_order('BTC_XMR', '0.02', '1')
+    registry.update_frozen({'BTC_XMR': dict(TICKER['BTC_ETH'], isFrozen='0'), 'BTC_NEW': TICKER['BTC_ETH']})
+    assert registry.check_order('BTC_XMR', '0.02', '1') is None
+    assert registry.check_order('BTC_NOPE', '1', '1') is None  # unknown, so left for poloniex to judge
+    assert 'positive' in registry.check_order('USDT_BTC', '-600', '1')
+    path = str(tmpdir.join('cache', 'markets.json'))
+    registry.save(path)
+    loaded = MarketRegistry()
+    loaded.read(path)
+    assert loaded.updated == 1000
+    assert loaded.pairs == registry.pairs
+    assert loaded.format_market('BTC_XMR') == 'XMR_BTC'
@@ -0,0 +1,82 @@
+"""AsyncPoloniex against test/stub_exchange.py, with the plugin's database halves replaced by recorders."""
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+from poloniex_async import AsyncPoloniex
+from test.stub_exchange import StubExchange, StubOrder, reset_plugin, stub_plugin
+
+
+class TestAsyncPoloniex(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubExchange(trades=25, page_size=10).start()
+        self.plugin = stub_plugin(self.stub)
+        self.client = AsyncPoloniex(self.plugin)
+        self.calls = {}
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.client.close()
+        self.stub.stop()
+        reset_plugin()
+
+    def record(self, name, result=None):
+        """Replace the plugin's method name, recording its arguments and returning result (or result(*args))."""
+        calls = self.calls.setdefault(name, [])
+
+        def replacement(*args, **kwargs):
+            calls.append(args)
+            return result(*args, **kwargs) if callable(result) else result
+        setattr(self.plugin, name, replacement)
+
+    @inlineCallbacks
+    def test_sync_ticker_and_balances(self):
+        self.record('apply_ticker')
+        self.record('apply_balances')
+        yield self.client.sync_ticker('BTC_USD')
+        yield self.client.sync_balances()
+        assert self.calls['apply_ticker'] == [(self.stub.markets, 'BTC_USD')]
+        assert self.calls['apply_balances'] == [(self.stub.balances,)]
+
+    @inlineCallbacks
+    def test_nonces_are_taken_off_the_reactor(self):
+        from twisted.python import threadable
+        threads = []
+        sign_request = self.plugin.sign_request
+
+        def sign(method, params):
+            threads.append(threadable.isInIOThread())
+            return sign_request(method, params)
+        self.plugin.sign_request = sign
+        response = yield self.client.submit_private_request('returnCompleteBalances')
+        assert response == self.stub.balances
+        assert threads == [False]
+
+    @inlineCallbacks
+    def test_sync_trades(self):
+        self.record('start_trade_sync', lambda market, rescan, tstart: (None, tstart))
+        self.record('apply_trade_page', lambda trades, market, tend, rescan: tend)
+        self.record('finish_trade_sync')
+        yield self.client.sync_trades()
+        (page, market, _, rescan), = self.calls['apply_trade_page']
+        assert market is None and not rescan
+        assert len(page['USDT_BTC']) == 10
+        assert len(self.calls['finish_trade_sync']) == 1
+
+    @inlineCallbacks
+    def test_create_and_cancel_orders(self):
+        options = {'currencyPair': 'USDT_BTC', 'rate': '600.00000000', 'amount': '0.01000000'}
+        self.record('prepare_order', lambda oid, expire, order=None, loaded=False: (StubOrder(oid), 'buy',
+                                                                                    dict(options)))
+        self.record('apply_created_orders', lambda results: [order for order, _, resp in results
+                                                             if resp and 'orderNumber' in resp])
+        created = yield self.client.create_orders([-1, -2, -3])
+        assert len(created) == 3
+        assert len(self.stub.orders) == 3
+
+        self.record('apply_open_orders', lambda oorders, market: [StubOrder(row['orderNumber'])
+                                                                  for pair in oorders for row in oorders[pair]])
+        self.record('apply_cancelled_orders', lambda results: sum(1 for _, resp in results
+                                                                  if resp and 'success' in resp))
+        cancelled, _ = yield self.client.cancel_orders()
+        assert cancelled == 3
+        assert self.stub.orders == {}
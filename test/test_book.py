@@ -0,0 +1,82 @@
+import pytest
+
+from poloniex_book import PENDING_LIMIT, BookGap, BookSnapshot, OrderBook
+
+SNAPSHOT = {'bids': [['99.0', '1'], ['98.0', '2']], 'asks': [['101.0', '1'], ['102.0', '5'], ['103.0', '1']],
+            'isFrozen': '0', 'seq': 10}
+
+
+def modify(side, rate, amount):
+    return {'type': 'orderBookModify', 'data': {'type': side, 'rate': rate, 'amount': amount}}
+
+
+def remove(side, rate):
+    return {'type': 'orderBookRemove', 'data': {'type': side, 'rate': rate}}
+
+
+def test_snapshot_and_updates():
+    book = OrderBook('BTC_USD')
+    book.load_snapshot(SNAPSHOT)
+    assert book.top() == ((99.0, 1.0), (101.0, 1.0))
+    book.apply(11, [modify('bid', '99.5', '3'), remove('ask', '101.0')])
+    assert book.top() == ((99.5, 3.0), (102.0, 5.0))
+    book.apply(12, [modify('bid', '99.5', '0')])
+    assert book.depth(2) == ([(99.0, 1.0), (98.0, 2.0)], [(102.0, 5.0), (103.0, 1.0)])
+    book.apply(12, [modify('ask', '90', '1')])  # stale, ignored
+    assert book.seq == 12
+    assert book.asks.best() == (102.0, 5.0)
+
+
+def test_updates_before_snapshot_are_replayed():
+    book = OrderBook('BTC_USD')
+    book.apply(10, [modify('bid', '50', '1')])  # already in the snapshot
+    book.apply(11, [modify('bid', '99.5', '3')])
+    assert not book.seeded
+    book.load_snapshot(SNAPSHOT)
+    assert book.seq == 11
+    assert book.bids.levels() == [(99.5, 3.0), (99.0, 1.0), (98.0, 2.0)]
+
+
+def test_gap_unseeds_book():
+    book = OrderBook('BTC_USD')
+    book.load_snapshot(SNAPSHOT)
+    with pytest.raises(BookGap):
+        book.apply(13, [modify('bid', '99.5', '3')])
+    assert not book.seeded
+    book.load_snapshot(dict(SNAPSHOT, seq=12))
+    assert book.seq == 13
+    assert book.bids.best() == (99.5, 3.0)
+
+
+def test_pending_messages_are_bounded():
+    book = OrderBook('BTC_USD')
+    for seq in range(11, 11 + PENDING_LIMIT + 5):
+        book.apply(seq, [modify('bid', '99.5', '3')])
+    assert len(book._pending) == PENDING_LIMIT
+    with pytest.raises(BookGap):  # messages 11 to 15 were dropped
+        book.load_snapshot(SNAPSHOT)
+    book.load_snapshot(dict(SNAPSHOT, seq=15 + PENDING_LIMIT))
+    assert book.seq == 15 + PENDING_LIMIT
+
+
+def test_book_snapshot_roundtrip_and_analytics():
+    snap = BookSnapshot.from_response('BTC_USD', SNAPSHOT)
+    snap = BookSnapshot.from_bytes(snap.to_bytes())
+    assert snap.market == 'BTC_USD'
+    assert snap.seq == 10
+    assert list(snap.ask_prices) == [101.0, 102.0, 103.0]
+    assert list(snap.cumulative_depth('bid')) == [1.0, 6.0, 7.0]
+    assert list(snap.cumulative_depth('ask')) == [1.0, 3.0]
+    assert snap.vwap('bid', 1) == 101.0
+    assert snap.vwap('bid', 3) == (101.0 + 2 * 102.0) / 3
+    assert snap.vwap('ask', 2) == (99.0 + 98.0) / 2
+    assert snap.vwap('bid', 8) is None
+    assert abs(snap.slippage('bid', 3) - ((101.0 + 2 * 102.0) / 3 - 101.0) / 101.0) < 1e-12
+
+
+def test_book_snapshot_from_book():
+    book = OrderBook('BTC_USD')
+    book.load_snapshot(SNAPSHOT)
+    snap = BookSnapshot.from_book(book, 2)
+    assert list(snap.bid_prices) == [99.0, 98.0]
+    assert list(snap.ask_sizes) == [1.0, 5.0]
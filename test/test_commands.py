@@ -1,3 +1,4 @@
+import datetime
 import json
 import os
 import time
@@ -10,6 +11,7 @@ from poloniex_manager import Poloniex
 
 from sqlalchemy_models import get_schemas, wallet as wm, exchange as em
 
+from test.stub_exchange import StubExchange, StubOrder, reset_plugin, stub_plugin
 from trade_manager.helper import start_test_man, stop_test_man
 from trade_manager.plugin import get_orders, get_trades, sync_ticker, get_debits, sync_balances, \
     get_credits, \
@@ -90,6 +92,25 @@ class TestPluginRunning(unittest.TestCase):
         assert len(corder) == 1
         assert corder[0].state == 'closed'
 
+    def test_replace_order(self):
+        order = create_order('poloniex', 100, 0.01, 'BTC_USD', 'bid', session=poloniex.session, expire=time.time()+60)
+        oorder = get_orders(oid=order.id, session=poloniex.session)
+        countdown = 1000
+        while oorder[0].state == 'pending' and countdown > 0:
+            countdown -= 1
+            oorder = get_orders(oid=order.id, session=poloniex.session)
+            if oorder[0].state == 'pending':
+                time.sleep(0.01)
+                poloniex.session.close()
+        assert oorder[0].state == 'open'
+        moved = poloniex.replace_order(101, order=oorder[0])
+        assert moved.state == 'open'
+        assert moved.price == Amount("101 USD")
+        assert moved.order_id != oorder[0].order_id
+        assert oorder[0].state == 'closed'
+        poloniex.cancel_order(order=moved)
+        assert moved.state == 'closed'
+
     def test_cancel_order_order_id(self):
         poloniex.sync_orders()
         order = create_order('poloniex', 100, 0.01, 'BTC_USD', 'bid', session=poloniex.session, expire=time.time()+60)
@@ -263,6 +284,15 @@ class TestPluginRunning(unittest.TestCase):
 
         assert newtrades > trades
 
+    def test_sync_trades_cursor(self):
+        before = time.time()
+        poloniex.sync_trades()
+        cursor = poloniex.get_cursor('trades_all')
+        assert before <= cursor['watermark'] <= time.time()
+        assert 'backfill' not in cursor
+        poloniex.sync_trades()
+        assert poloniex.get_cursor('trades_all')['watermark'] >= cursor['watermark']
+
     def test_sync_credits(self):
         try:
             poloniex.session.delete(poloniex.session.query(wm.Credit).filter(wm.Credit.network == 'poloniex').first())
@@ -314,3 +344,213 @@ class TestPluginRunning(unittest.TestCase):
                 time.sleep(0.01)
         tick = json.loads(ticker)
         assert validate(tick, SCHEMAS['Ticker']) is None
+
+
+def unique_id():
+    """A number no trade, ledger row or order the tests create has used before."""
+    return int(time.time() * 1000000)
+
+
+def test_handle_trades_skips_duplicates_and_known():
+    gid = unique_id()
+    row = {'globalTradeID': gid, 'tradeID': str(gid), 'date': '2016-05-01 12:34:56', 'rate': '600.00000000',
+           'amount': '0.01000000', 'total': '6.00000000', 'fee': '0.00150000', 'orderNumber': str(gid),
+           'type': 'buy', 'category': 'exchange'}
+    tend, changed = poloniex.handle_trades('BTC_USD', [row, dict(row)], time.time())
+    assert changed
+    assert tend == 1462106096
+    poloniex.session.commit()
+    assert poloniex.session.query(em.Trade).filter(em.Trade.trade_id == 'poloniex|%s' % gid).count() == 1
+    tend, changed = poloniex.handle_trades('BTC_USD', [row], time.time())
+    assert not changed
+
+
+def test_handle_ledgers_skip_duplicates_and_known():
+    n = unique_id()
+    deposit = {'txid': 'test%s' % n, 'currency': 'BTC', 'amount': '1.00000000', 'address': '1testaddress',
+               'timestamp': 1462106096, 'confirmations': 6, 'status': 'COMPLETE'}
+    withdrawal = {'withdrawalNumber': n, 'currency': 'BTC', 'amount': '0.50000000', 'address': '1testaddress',
+                  'timestamp': 1462106096, 'status': 'COMPLETE: test%s' % n}
+    credits = poloniex.handle_deposits([deposit, dict(deposit)])
+    debits = poloniex.handle_withdrawals([withdrawal, dict(withdrawal)])
+    assert len(credits) == len(debits) == 1
+    assert credits[0].time == debits[0].time == datetime.datetime(2016, 5, 1, 12, 34, 56)  # UTC, like trades
+    poloniex.bulk_commit(credits + debits)
+    assert poloniex.handle_deposits([deposit]) == []
+    assert poloniex.handle_withdrawals([withdrawal]) == []
+
+
+def test_apply_balances_writes_emptied_balance():
+    zero = {'available': '0.00000000', 'onOrders': '0.00000000', 'btcValue': '0.00000000'}
+
+    def balance(currency):
+        poloniex.session.close()
+        bal = poloniex.session.query(wm.Balance).filter(wm.Balance.user_id == poloniex.manager_user.id,
+                                                        wm.Balance.currency == currency).first()
+        if bal is not None:
+            bal.load_commodities()
+        return bal
+
+    poloniex.apply_balances({'XTST': {'available': '1.50000000', 'onOrders': '0.25000000', 'btcValue': '0'}})
+    bal = balance('XTST')
+    assert bal.total == Amount("1.75 XTST")
+    assert bal.available == Amount("1.5 XTST")
+    poloniex.apply_balances({'XTST': zero, 'XNIL': zero})
+    bal = balance('XTST')
+    assert bal.total == Amount("0 XTST")
+    assert bal.available == Amount("0 XTST")
+    assert balance('XNIL') is None  # never held, so not worth a row
+
+
+def test_close_vanished_orders():
+    n = unique_id()
+    rows = [{'orderNumber': str(n), 'type': 'buy', 'rate': '100.00000000', 'amount': '0.01000000',
+             'total': '1.00000000'},
+            {'orderNumber': str(n + 1), 'type': 'sell', 'rate': '1000.00000000', 'amount': '0.01000000',
+             'total': '10.00000000'}]
+    orders = poloniex.apply_open_orders(rows, 'BTC_USD')
+    assert [o.state for o in orders] == ['open', 'open']
+    assert [o.id for o in poloniex.apply_open_orders(rows, 'BTC_USD')] == [o.id for o in orders]  # known
+    poloniex.close_vanished_orders(orders[:1])
+    assert orders[0].state == 'open'
+    assert orders[1].state == 'closed'
+
+
+def test_sync_balances_unchanged():
+    poloniex.fingerprints.forget('returnCompleteBalances')
+    poloniex.sync_balances()
+    poloniex.sync_balances()
+    assert poloniex.fingerprints.stats()['returnCompleteBalances']['hits'] >= 1
+
+
+def test_sync_tickers():
+    ticks = poloniex.sync_tickers(['BTC_USD', 'ETH_BTC'])
+    assert set(ticks) == set(['BTC_USD', 'ETH_BTC'])
+    for market in ticks:
+        tick = json.loads(get_ticker('poloniex', market))
+        assert validate(tick, SCHEMAS['Ticker']) is None
+    tickers = poloniex.get_tickers(['BTC_USD', 'ETH_BTC', 'NOPE_BTC'])
+    assert set(tickers) == set(['BTC_USD', 'ETH_BTC'])
+    assert tickers['BTC_USD']['market'] == 'BTC_USD'
+
+
+def test_check_order():
+    poloniex.refresh_markets(force=True)
+    assert poloniex.market_registry.updated is not None
+    assert poloniex.check_order({'currencyPair': 'USDT_BTC', 'rate': '100', 'amount': '0.01'}) is None
+    rejected = poloniex.check_order({'currencyPair': 'USDT_BTC', 'rate': '100', 'amount': '0.0001'})
+    assert 'Total must be at least' in rejected['error']
+
+
+class TestAgainstStub(unittest.TestCase):
+    """The plugin against test/stub_exchange.py, so no live poloniex account is needed."""
+
+    def setUp(self):
+        self.stub = StubExchange().start()
+        self.plugin = stub_plugin(self.stub)
+
+    def tearDown(self):
+        self.stub.stop()
+        reset_plugin()
+
+    def keep_cursor(self, stream):
+        """Put stream's saved sync position back as it was after the test."""
+        key = self.plugin.cursor_key(stream)
+        saved = self.plugin.red.get(key)
+        self.addCleanup(lambda: self.plugin.red.set(key, saved) if saved else self.plugin.red.delete(key))
+
+    def test_sync_credits_keeps_watermark_on_error(self):
+        self.keep_cursor('ledgers')
+        self.plugin.set_cursor('ledgers', watermark=1000)
+        self.stub.error_rate = 1.0
+        self.plugin.sync_credits()
+        assert self.plugin.get_cursor('ledgers')['watermark'] == 1000
+        self.stub.error_rate = 0.0
+        self.plugin.sync_credits()
+        assert self.plugin.get_cursor('ledgers')['watermark'] > 1000
+
+    def test_backfill_counts_failed_windows(self):
+        self.keep_cursor('trades_all')
+        self.plugin.red.delete(self.plugin.cursor_key('trades_all'))
+        self.stub.error_rate = 1.0
+        stats = self.plugin.backfill_trades(begin=time.time() - 3600)
+        assert stats['failed'] == stats['windows'] == 1
+        assert 'watermark' not in self.plugin.get_cursor('trades_all')
+
+    def test_mass_cancel_survives_nonce_races(self):
+        self.stub.latency = 0.01
+        orders = [StubOrder(self.stub.add_order('USDT_BTC', 'buy', 600, 0.01)) for _ in range(200)]
+        cancelled, _ = self.plugin.mass_cancel(orders, workers=8)
+        assert cancelled == 200
+        assert self.stub.orders == {}
+
+    def pending_orders(self, n):
+        """n pending BTC_USD bids in the database, as trade_manager's create_order leaves them for the plugin."""
+        tag = unique_id()
+        orders = [em.LimitOrder(Amount("%.2f USD" % (100 + i)), Amount("0.01 BTC"), 'BTC_USD', 'bid',
+                                'poloniex', 'tmp|test%s%03d' % (tag, i), exec_amount=Amount("0 BTC"), state='pending')
+                  for i in range(n)]
+        self.plugin.session.add_all(orders)
+        self.plugin.session.commit()
+
+        def cleanup():
+            for order in orders:
+                self.plugin.session.delete(order)
+            self.plugin.session.commit()
+        self.addCleanup(cleanup)
+        return orders
+
+    def test_create_and_replace_orders(self):
+        orders = self.pending_orders(3)
+        created = self.plugin.create_orders([o.id for o in orders])
+        assert sorted(o.id for o in created) == sorted(o.id for o in orders)
+        assert [o.state for o in orders] == ['open'] * 3
+        assert len(self.stub.orders) == 3
+
+        order = orders[0]
+        self.stub.fill(order.order_id.split('|')[1], '0.004')
+        order.exec_amount = Amount("0.004 BTC")
+        self.plugin.session.commit()
+        moved = self.plugin.replace_order(101, order=order)
+        self.addCleanup(lambda: self.plugin.session.delete(moved) or self.plugin.session.commit())
+        assert order.state == 'closed'
+        assert moved.state == 'open'
+        assert moved.amount == Amount("0.006 BTC")
+        assert moved.exec_amount == Amount("0 BTC")
+        pair, row = self.stub.orders[moved.order_id.split('|')[1]]
+        assert float(row['amount']) == 0.006
+        assert float(row['rate']) == 101
+
+        cancelled, seconds = self.plugin.cancel_orders(market='BTC_USD')
+        assert cancelled == 3 and seconds > 0
+        assert self.stub.orders == {}
+
+    def test_sync_ticker_without_ticker(self):
+        assert self.plugin.sync_ticker('NOPE_BTC') is None
+        Poloniex._ticker_cache = None
+        self.stub.error_rate = 1.0
+        assert self.plugin.sync_ticker('BTC_USD') is None
+
+    def test_refresh_markets(self):
+        registry = self.plugin.refresh_markets()
+        assert sorted(registry.pairs) == sorted(self.stub.markets)
+        assert os.path.exists(self.plugin.market_cache)
+        self.stub.stop()
+        assert self.plugin.refresh_markets(force=True) is registry  # logged, not raised
+        assert sorted(registry.pairs) == sorted(self.stub.markets)
+
+    def test_create_orders_loads_orders_once(self):
+        orders = self.pending_orders(2)
+        queries = []
+        query = self.plugin.session.query
+        self.plugin.session.query = lambda *args, **kwargs: queries.append(args) or query(*args, **kwargs)
+        self.addCleanup(delattr, self.plugin.session, 'query')
+        created = self.plugin.create_orders([o.id for o in orders] + [-1, -2])  # two not found
+        assert len(created) == 2
+        assert len([args for args in queries if args[0] is em.LimitOrder]) == 1
+
+    def test_connection_refused(self):
+        self.stub.stop()
+        assert self.plugin.submit_public_request('returnTicker') is None
+        assert self.plugin.submit_private_request('returnCompleteBalances') is None
+        assert self.plugin.metrics.snapshot()['counters']['error'] == {'returnTicker': 1, 'returnCompleteBalances': 1}
@@ -0,0 +1,64 @@
+import json
+
+from poloniex_listener import TICKER_STATS_KEY, TickerWriter
+from test.stub_exchange import ticker_feed
+
+
+class FakeRedis(object):
+    """Just enough of a redis client for TickerWriter: non-transactional pipelines of mset, hmset and set."""
+
+    def __init__(self):
+        self.data = {}
+        self.fail = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+    def __init__(self, red):
+        self.red = red
+        self.commands = []
+
+    def set(self, key, value):
+        self.commands.append({key: value})
+
+    def mset(self, mapping):
+        self.commands.append(mapping)
+
+    def execute(self):
+        if self.red.fail:
+            raise IOError("Connection refused")
+        for mapping in self.commands:
+            self.red.data.update(mapping)
+
+
+def test_ticker_writer_coalesces():
+    red = FakeRedis()
+    writer = TickerWriter(red)
+    writer.flush()  # nothing to write
+    assert red.data == {}
+    for message in ticker_feed(5):
+        writer.add(message)
+    writer.flush()
+    assert writer.stats() == {'received': 5, 'coalesced': 3, 'written': 2, 'errors': 0}
+    assert json.loads(red.data[TICKER_STATS_KEY]) == writer.stats()
+    tick = json.loads(red.data['poloniex_BTC_USD_ticker'])
+    assert tick['market'] == 'BTC_USD' and tick['exchange'] == 'poloniex'
+    assert tick['last'] == float(list(ticker_feed(5))[3][1])  # the latest USDT_BTC message
+    assert json.loads(red.data['poloniex_ETH_BTC_ticker'])['market'] == 'ETH_BTC'
+
+
+def test_ticker_writer_survives_redis_errors():
+    red = FakeRedis()
+    writer = TickerWriter(red)
+    red.fail = True
+    for message in ticker_feed(2):
+        writer.add(message)
+    writer.flush()  # logged, not raised, and the ticks are kept
+    assert writer.stats() == {'received': 2, 'coalesced': 0, 'written': 0, 'errors': 1}
+    assert len(writer.latest) == 2
+    red.fail = False
+    writer.flush()
+    assert writer.stats()['written'] == 2
+    assert 'poloniex_BTC_USD_ticker' in red.data and 'poloniex_ETH_BTC_ticker' in red.data
@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+
+from poloniex_api import FileNonce, LocalNonce, PoloniexTransport
+from test.stub_exchange import StubExchange
+
+PER_WORKER = 500
+
+
+def allocate(nonces, n=PER_WORKER):
+    return [nonces.next_nonce() for _ in range(n)]
+
+
+def allocate_from_file(path, queue):
+    queue.put(allocate(FileNonce(path)))
+
+
+def check_unique_and_increasing(batches):
+    for batch in batches:
+        assert batch == sorted(batch)
+        assert len(set(batch)) == len(batch)
+    everything = [n for batch in batches for n in batch]
+    assert len(set(everything)) == len(everything)
+
+
+def hammer_threads(nonces, workers=8):
+    batches = []
+
+    def worker():
+        batches.append(allocate(nonces))
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return batches
+
+
+def test_local_nonce_threads():
+    check_unique_and_increasing(hammer_threads(LocalNonce()))
+
+
+def test_file_nonce_threads_and_processes():
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'nonce')
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=allocate_from_file, args=(path, queue)) for _ in range(4)]
+        for p in procs:
+            p.start()
+        batches = hammer_threads(FileNonce(path), workers=4)
+        batches.extend(queue.get() for _ in procs)
+        for p in procs:
+            p.join()
+        check_unique_and_increasing(batches)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_file_nonce_interleaved_clients_against_stub():
+    """Two clients sharing a key, as two plugin processes would, never trip the exchange's nonce check."""
+    tmp = tempfile.mkdtemp()
+    stub = StubExchange().start()
+    try:
+        path = os.path.join(tmp, 'nonce')
+        clients = [FileNonce(path), FileNonce(path)]
+        transport = PoloniexTransport()
+        for i in range(200):
+            nonce = clients[i % 2].next_nonce()
+            transport.post('returnCompleteBalances', stub.priv_url,
+                           data={'command': 'returnCompleteBalances', 'nonce': nonce}, headers={})
+        assert stub.nonce_errors == 0
+    finally:
+        stub.stop()
+        shutil.rmtree(tmp)
@@ -0,0 +1,45 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from poloniex_profile import SamplingProfiler, classify
+
+
+def test_classify():
+    sync = ('/x/poloniex_manager.py', 'sync_balances')
+    assert classify([sync, ('/x/sqlalchemy/orm/session.py', 'commit'),
+                     ('/x/sqlalchemy/engine/base.py', 'execute')]) == ('sync_balances', 'commit')
+    assert classify([sync, ('/x/sqlalchemy/orm/query.py', 'all')]) == ('sync_balances', 'orm')
+    assert classify([sync, ('/x/poloniex_api.py', 'loads')]) == ('sync_balances', 'json')
+    assert classify([sync, ('/x/requests/sessions.py', 'post')]) == ('sync_balances', 'http')
+    assert classify([sync, ('/x/poloniex_api.py', 'acquire')]) == ('sync_balances', 'rate_limit')
+    assert classify([('/x/bench.py', 'main')]) == (None, 'python')
+
+
+def test_profile_written():
+    tmp = tempfile.mkdtemp()
+    done = threading.Event()
+
+    def busy():
+        while not done.is_set():
+            json.loads(json.dumps({'rows': list(range(100))}))
+
+    worker = threading.Thread(target=busy, name='busy')
+    worker.start()
+    try:
+        profiler = SamplingProfiler(os.path.join(tmp, 'profiles', 'test'), seconds=0.3, interval=0.005).start()
+        profiler.join()
+        assert not profiler.running
+        with open(os.path.join(tmp, 'profiles', 'test.folded')) as f:
+            stacks = [line for line in f if line.startswith('busy;')]
+        assert len(stacks) > 0
+        with open(os.path.join(tmp, 'profiles', 'test.json')) as f:
+            summary = json.load(f)
+        assert summary['samples'] > 10
+        assert summary['syncs']['other']['json'] > 0
+    finally:
+        done.set()
+        worker.join()
+        shutil.rmtree(tmp)
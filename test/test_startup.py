@@ -0,0 +1,19 @@
+import subprocess
+import sys
+
+
+def imports_cleanly(code):
+    """Run code in a fresh interpreter, returning whether it succeeded."""
+    return subprocess.call([sys.executable, '-c', code]) == 0
+
+
+def test_api_import_is_light():
+    assert imports_cleanly("import sys, poloniex_api; "
+                           "assert 'requests' not in sys.modules and 'sqlalchemy' not in sys.modules; "
+                           "assert poloniex_api.format_market('USDT_BTC') == 'BTC_USD'")
+
+
+def test_listener_import_has_no_side_effects():
+    assert imports_cleanly("import sys, poloniex_listener; "
+                           "assert poloniex_listener.poloniex is None and poloniex_listener.red is None; "
+                           "assert 'poloniex_manager' not in sys.modules and 'sqlalchemy' not in sys.modules")
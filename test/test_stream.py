@@ -0,0 +1,65 @@
+import json
+import resource
+
+import pytest
+
+from poloniex_api import RowStream, batches
+
+TRADE = {'globalTradeID': 12345678, 'tradeID': '1234567', 'date': '2016-05-01 12:34:56', 'rate': '600.00000000',
+         'amount': '0.01000000', 'total': '6.00000000', 'fee': '0.00150000', 'orderNumber': '2000000',
+         'type': 'buy', 'category': 'exchange'}
+
+
+def chunked(body, size):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 4096])
+def test_rows_match_json_loads(size):
+    body = {'USDT_BTC': [TRADE, dict(TRADE, type='sell')], 'BTC_ETH': [dict(TRADE, rate='0.02')]}
+    rows = list(RowStream(chunked(json.dumps(body).encode('utf-8'), size)))
+    assert sorted(json.dumps(r, sort_keys=True) for r in rows) == \
+        sorted(json.dumps((pair, row), sort_keys=True) for pair in body for row in body[pair])
+    listed = list(RowStream(chunked(json.dumps([TRADE, TRADE]).encode('utf-8'), size)))
+    assert listed == [(None, TRADE), (None, TRADE)]
+    ledgers = {'deposits': [{'currency': 'BTC', 'address': u'\u00e9}{"', 'amount': '1.0'}], 'withdrawals': []}
+    assert list(RowStream(chunked(json.dumps(ledgers).encode('utf-8'), size))) == \
+        [('deposits', ledgers['deposits'][0])]
+
+
+def test_error_and_empty_bodies():
+    error = RowStream(chunked(b'{"error": "Invalid nonce parameter."}', 5))
+    assert 'error' in error
+    assert error.get('error') == 'Invalid nonce parameter.'
+    assert not error
+    assert list(error) == []
+    assert not RowStream([b'[]'])
+    with pytest.raises(ValueError):
+        list(RowStream(chunked(json.dumps([TRADE, TRADE]).encode('utf-8')[:-30], 64)))
+
+
+def test_batches():
+    rows = [('a', 1), ('a', 2), ('a', 3), ('b', 4)]
+    assert list(batches(rows, 2)) == [('a', [1, 2]), ('a', [3]), ('b', [4])]
+
+
+def test_peak_rss_is_bounded():
+    """Stream a ~250MB returnTradeHistory body, which is never held in memory whole, and check RSS barely moves."""
+    row = json.dumps(TRADE).encode('utf-8')
+    chunk = b', '.join([row] * 256)
+    nchunks = 250 * 1024 * 1024 // len(chunk)
+
+    def body():
+        yield b'{"USDT_BTC": ['
+        for i in range(nchunks):
+            yield (b', ' if i else b'') + chunk
+        yield b']}'
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KiB on linux
+    count = 0
+    for pair, rows in batches(RowStream(body()), 500):
+        count += len(rows)
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    assert count == nchunks * 256
+    assert grown < 32 * 1024, "peak RSS grew by %s KiB" % grown